@@ -0,0 +1,75 @@
+""" Attention backends: parity against eager and CPU throughput / peak memory
+
+Each backend is timed in its own process so the peak memory belongs to that backend only.
+Shapes follow ViT-B/16 at 224px (197 tokens, 768 dim, 12 heads).
+
+Run from the repo root:
+    python -m benchmarks.bench_attention --batch_size 32
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import time_fn, peak_memory_mb, run_isolated
+from models.vision_transformer import Attention, ATTN_BACKENDS
+
+
+def check_parity(dim=768, num_heads=12, tokens=197):
+    torch.manual_seed(0)
+    eager = Attention(dim, num_heads=num_heads, qkv_bias=True)
+    x = torch.randn(4, tokens, dim)
+    x_ref = x.clone().requires_grad_(True)
+    ref = eager(x_ref)
+    ref.sum().backward()
+    for backend in ATTN_BACKENDS[1:]:
+        attn = Attention(dim, num_heads=num_heads, qkv_bias=True, attn_backend=backend)
+        attn.load_state_dict(eager.state_dict())
+        x_in = x.clone().requires_grad_(True)
+        out = attn(x_in)
+        out.sum().backward()
+        err = (out - ref).abs().max().item()
+        grad_err = (x_in.grad - x_ref.grad).abs().max().item()
+        # weight grads sum over batch and tokens, compare relative to their magnitude
+        w_err = ((attn.qkv.weight.grad - eager.qkv.weight.grad).abs().max() / eager.qkv.weight.grad.abs().max()).item()
+        print('parity {:<8s} out: {:.2e}  grad x: {:.2e}  grad qkv (rel): {:.2e}'.format(backend, err, grad_err, w_err))
+        assert max(err, grad_err, w_err) < 1e-4
+
+
+def run(backend, batch_size, dim, num_heads, tokens, iters, train, threads):
+    if threads:
+        torch.set_num_threads(threads)
+    attn = Attention(dim, num_heads=num_heads, qkv_bias=True, attn_backend=backend)
+    x = torch.randn(batch_size, tokens, dim, requires_grad=train)
+
+    def step():
+        if train:
+            attn(x).sum().backward()
+        else:
+            with torch.no_grad():
+                attn(x)
+
+    t = time_fn(step, iters)
+    return dict(backend=backend, ms=t, samples_s=batch_size / t * 1e3, peak_mb=peak_memory_mb())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--num_heads', type=int, default=12)
+    parser.add_argument('--tokens', type=int, default=197)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    check_parity(args.dim, args.num_heads, args.tokens)
+    for train in (False, True):
+        for backend in ATTN_BACKENDS:
+            res = run_isolated(run, backend, args.batch_size, args.dim, args.num_heads, args.tokens, args.iters,
+                               train, args.threads)
+            print('{:<5s} {backend:<8s} {ms:8.2f} ms  {samples_s:8.1f} samples/s  peak {peak_mb:7.0f} MB'.format(
+                'train' if train else 'eval', **res))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" Activation checkpointing policies: peak memory vs training step time
+
+Each policy trains the adapters of a WST model (frozen backbone) for a few steps in a fresh process, so the
+peak RSS (CPU) or allocator high-water mark (CUDA) belongs to that policy alone. Gradients are checked
+against the run without checkpointing first.
+
+Run from the repo root:
+    python -m benchmarks.bench_checkpoint --batch_size 16
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, peak_memory_mb, run_isolated, make_trainable
+from models.vision_transformer import VisionTransformer
+
+POLICIES = [('none', 1), ('blocks', 1), ('blocks', 2), ('blocks', 4), ('attn', 1), ('mlp', 1)]
+
+
+def build(policy, every, device):
+    torch.manual_seed(0)
+    model = make_trainable(VisionTransformer(num_classes=10, drop_path_rate=0.1)).to(device)
+    model.set_grad_checkpointing(policy, every=every)
+    return model
+
+
+def step_fn(model, x, target):
+    criterion = nn.CrossEntropyLoss()
+
+    def step():
+        torch.manual_seed(0)  # same drop path masks in every run
+        criterion(model(x), target).backward()
+    return step
+
+
+def grads(policy, every, device):
+    model = build(policy, every, device)
+    x, target = torch.randn(2, 3, 224, 224, device=device), torch.randint(0, 10, (2,), device=device)
+    step_fn(model, x, target)()
+    return {n: p.grad.cpu() for n, p in model.named_parameters() if p.grad is not None}
+
+
+def measure(policy, every, batch_size, iters, threads, device):
+    if threads:
+        torch.set_num_threads(threads)
+    model = build(policy, every, device)
+    x = torch.randn(batch_size, 3, 224, 224, device=device)
+    target = torch.randint(0, 10, (batch_size,), device=device)
+    step = step_fn(model, x, target)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    ms = time_fn(step, iters, warmup=1, device=device)
+    return ms, peak_memory_mb(device)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--iters', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    ref = grads('none', 1, args.device)
+    for policy, every in POLICIES[1:]:
+        out = grads(policy, every, args.device)
+        err = max((out[n] - g).abs().max().item() for n, g in ref.items())
+        print('grad parity {} (every {}): {:.2e}'.format(policy, every, err))
+        assert err < 1e-5
+
+    print('bs {}  device {}'.format(args.batch_size, args.device))
+    base = None
+    for policy, every in POLICIES:
+        ms, mb = run_isolated(measure, policy, every, args.batch_size, args.iters, args.threads, args.device)
+        base = base or (ms, mb)
+        print('{:7s} every {}: {:8.0f} ms/step ({:.2f}x)  peak {:7.0f} MB ({:.2f}x)'.format(
+            policy, every, ms, ms / base[0], mb, mb / base[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+""" fast_collate: per-sample accumulation into a fresh zeroed tensor vs one stack into a (reused) buffer
+
+Samples are uint8 CHW arrays as ToNumpy produces them (non-contiguous HWC views) and as the VTAB cache
+serves them (contiguous rows of a memmap). The contiguous case also times the batched VTAB.__getitems__ path,
+where the whole batch arrives as one block gathered from the memmap.
+
+Run from the repo root:
+    python -m benchmarks.bench_collate --batch_sizes 32 256
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from benchmarks.common import time_fn
+from data.vtab import ContiguousBatch
+from utils.utils import FastCollate
+
+
+def old_fast_collate(batch):
+    """ fast_collate as it was before FastCollate, the baseline
+    """
+    batch_size = len(batch)
+    targets = torch.zeros(batch_size, dtype=torch.int64)
+    tensor = torch.zeros((batch_size, *batch[0][0].shape), dtype=torch.uint8)
+    for i in range(batch_size):
+        targets[i] += batch[i][1]
+        tensor[i] += torch.from_numpy(batch[i][0])
+    return tensor, targets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 256])
+    parser.add_argument('--img_size', type=int, default=224)
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    n = max(args.batch_sizes)
+    rng = np.random.RandomState(0)
+    hwc = rng.randint(0, 256, (n, args.img_size, args.img_size, 3), dtype=np.uint8)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = np.lib.format.open_memmap(os.path.join(tmp, 'cache.npy'), mode='w+', dtype=np.uint8,
+                                          shape=(n, 3, args.img_size, args.img_size))
+        cache[:] = hwc.transpose(0, 3, 1, 2)
+        cache.flush()
+        cache = np.load(os.path.join(tmp, 'cache.npy'), mmap_mode='c')
+
+        for bs in args.batch_sizes:
+            labels = rng.randint(0, 100, bs).tolist()
+            indices = rng.permutation(n)[:bs]
+            samples = {
+                'ToNumpy': [(np.rollaxis(hwc[i], 2), label) for i, label in zip(indices, labels)],
+                'memmap rows': [(cache[i], label) for i, label in zip(indices, labels)],
+            }
+            new, reused = FastCollate(), FastCollate(num_buffers=4)
+            for name, batch in samples.items():
+                ref, ref_targets = old_fast_collate(batch)
+                for collate in (new, reused):
+                    out, targets = collate(batch)
+                    assert torch.equal(out, ref) and torch.equal(targets, ref_targets)
+                t_old = time_fn(lambda: old_fast_collate(batch), args.iters)
+                t_new = time_fn(lambda: new(batch), args.iters)
+                t_reused = time_fn(lambda: reused(batch), args.iters)
+                print('bs {:3d} {:12s} old: {:6.2f} ms  new: {:6.2f} ms ({:.1f}x)  reused buffers: {:6.2f} ms ({:.1f}x)'
+                      .format(bs, name, t_old, t_new, t_old / t_new, t_reused, t_old / t_reused))
+
+            # batched fetch from the memmap, gather + collate, against per-sample fetch + old collate
+            out, _ = new(ContiguousBatch(cache[indices], labels))
+            assert torch.equal(out, old_fast_collate(samples['memmap rows'])[0])
+            t_old = time_fn(lambda: old_fast_collate([(cache[i], label) for i, label in zip(indices, labels)]),
+                            args.iters)
+            t_new = time_fn(lambda: new(ContiguousBatch(cache[indices], labels)), args.iters)
+            print('bs {:3d} {:12s} old: {:6.2f} ms  new: {:6.2f} ms ({:.1f}x)'.format(
+                bs, 'memmap block', t_old, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
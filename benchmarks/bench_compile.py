@@ -0,0 +1,55 @@
+""" CPU inference latency: eager vs torch.compile vs traced TorchScript (the torchscript format of export.py)
+
+Run from the repo root:
+    python -m benchmarks.bench_compile --batch_size 1 8 64
+    python -m benchmarks.bench_compile --merged   # the merged inference module instead of the training graph
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn
+from models.inference import merge_for_inference
+from models.vision_transformer import VisionTransformer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--merged', default=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = VisionTransformer(num_classes=100, scale=10.).eval()
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    if args.merged:
+        model = merge_for_inference(model)
+    model.requires_grad_(False)
+
+    compiled = torch.compile(model)
+    example = torch.randn(2, 3, 224, 224)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+
+    for bs in args.batch_size:
+        x = torch.randn(bs, 3, 224, 224)
+        with torch.no_grad():
+            ref = model(x)
+            for name, fn in (('compile', compiled), ('torchscript', traced)):
+                err = (fn(x) - ref).abs().max().item()
+                assert err < 1e-3, '{} differs from eager by {}'.format(name, err)
+            # compiles (and warms up) for this batch size before timing
+            t = {name: time_fn(lambda: fn(x), args.iters)
+                 for name, fn in (('eager', model), ('compile', compiled), ('torchscript', traced))}
+        print('bs {:3d}  eager: {:8.1f} ms  compile: {:8.1f} ms ({:.2f}x)  torchscript: {:8.1f} ms ({:.2f}x)'.format(
+            bs, t['eager'], t['compile'], t['eager'] / t['compile'], t['torchscript'], t['eager'] / t['torchscript']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+""" Eager WST model vs. the merged inference module from models/inference.py
+
+Checks that the logits match and reports CPU latency at a few batch sizes.
+
+Run from the repo root:
+    python -m benchmarks.bench_export --batch_size 1 32
+"""
+import argparse
+
+import torch
+
+from benchmarks.common import time_fn
+from models.inference import merge_for_inference
+from models.vision_transformer import VisionTransformer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--r', type=int, default=2)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = VisionTransformer(num_classes=100, r=args.r, scale=10.).eval()
+    # non-zero adapters so the side branch actually contributes
+    for block in model.blocks:
+        torch.nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    merged = merge_for_inference(model)
+
+    with torch.no_grad():
+        x = torch.randn(4, 3, 224, 224)
+        ref, out = model(x), merged(x)
+    err = (ref - out).abs().max().item()
+    print('parity max abs diff: {:.2e}'.format(err))
+    assert err < 1e-3
+
+    for batch_size in args.batch_size:
+        x = torch.randn(batch_size, 3, 224, 224)
+        with torch.no_grad():
+            t_eager = time_fn(lambda: model(x), args.iters)
+            t_merged = time_fn(lambda: merged(x), args.iters)
+        print('bs {:>4d}  eager: {:8.2f} ms  merged: {:8.2f} ms  speedup: {:.2f}x'.format(
+            batch_size, t_eager, t_merged, t_eager / t_merged))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Multi-task serving: parity with per-task models, memory per task and mixed-batch throughput
+
+Tasks are synthesized from random adapters on a shared random backbone, in the same format util.save writes.
+
+Run from the repo root:
+    python -m benchmarks.bench_multitask --num_tasks 4 --batch_size 32
+"""
+import argparse
+import copy
+import random
+
+import torch
+
+from benchmarks.common import time_fn
+from models.multitask import MultiTaskWST
+from models.vision_transformer import VisionTransformer
+
+
+def make_task(backbone, num_classes, r, scale):
+    model = copy.deepcopy(backbone)
+    model.reset_classifier(num_classes)
+    for block in model.blocks:
+        block.scale = scale
+        block.waveblock.adapter_down = torch.nn.Linear(model.embed_dim, r)
+        block.waveblock.adapter_up = torch.nn.Linear(r, model.embed_dim)
+    torch.nn.init.normal_(model.small_patch_embed.proj.weight, std=.02)
+    state = {n: p.data.clone() for n, p in model.named_parameters()
+             if 'small_' in n or 'adapter' in n or 'head' in n}
+    return model.eval(), state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_tasks', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    backbone = VisionTransformer(num_classes=0).eval()
+    engine = MultiTaskWST(backbone)
+    models = {}
+    for t in range(args.num_tasks):
+        name = 'task{}'.format(t)
+        models[name], state = make_task(backbone, num_classes=10 + t, r=2 + t % 3, scale=1. + t)
+        engine.register_task(name, state, scale=1. + t)
+
+    names = list(models)
+    tasks = [random.Random(i).choice(names) for i in range(8)]
+    x = torch.randn(len(tasks), 3, 224, 224)
+    with torch.no_grad():
+        mixed = engine(x, tasks)
+        err = max((mixed[i] - models[name](x[i:i + 1])[0]).abs().max().item() for i, name in enumerate(tasks))
+    print('parity mixed batch vs per-task models: {:.2e}'.format(err))
+    assert err < 1e-3
+
+    report = engine.memory_report()
+    print('backbone: {:.1f} MB'.format(report['backbone'] / 2 ** 20))
+    for name, nbytes in report['tasks'].items():
+        print('  {}: {:.3f} MB'.format(name, nbytes / 2 ** 20))
+    print('total: {:.1f} MB  vs {} separate models: {:.1f} MB'.format(
+        report['total'] / 2 ** 20, len(names), report['separate_models'] / 2 ** 20))
+
+    x = torch.randn(args.batch_size, 3, 224, 224)
+    tasks = [names[i % len(names)] for i in range(args.batch_size)]
+    t_mixed = time_fn(lambda: engine(x, tasks), args.iters)
+    t_single = time_fn(lambda: engine(x, names[0]), args.iters)
+    print('bs {}  single-task: {:.1f} img/s  mixed {} tasks: {:.1f} img/s'.format(
+        args.batch_size, args.batch_size / t_single * 1e3, len(names), args.batch_size / t_mixed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+""" PyTorch vs onnxruntime on CPU for the ONNX export of export.py
+
+Exports the WST model (and, with --merged, the merged inference module) with a dynamic batch dimension,
+checks the onnxruntime logits against PyTorch and compares latency. Needs onnx and onnxruntime.
+
+Run from the repo root:
+    python -m benchmarks.bench_onnx --batch_size 1 32
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn
+from export import export_onnx, OnnxRuntimeModule
+from models.inference import merge_for_inference
+from models.vision_transformer import VisionTransformer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--merged', default=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = VisionTransformer(num_classes=100, scale=10.).eval()
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    if args.merged:
+        model = merge_for_inference(model)
+    model.requires_grad_(False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'wst.onnx')
+        with torch.no_grad():
+            export_onnx(model, torch.randn(2, 3, 224, 224), path)
+        session = OnnxRuntimeModule(path, num_threads=torch.get_num_threads())
+
+        for bs in args.batch_size:
+            x = torch.randn(bs, 3, 224, 224)
+            with torch.no_grad():
+                err = (session(x) - model(x)).abs().max().item()
+                assert err < 1e-3, 'onnxruntime differs from PyTorch by {}'.format(err)
+                t_torch = time_fn(lambda: model(x), args.iters)
+            t_ort = time_fn(lambda: session(x), args.iters)
+            print('bs {:3d}  max abs diff {:.2e}  pytorch: {:8.1f} ms  onnxruntime: {:8.1f} ms ({:.2f}x)'.format(
+                bs, err, t_torch, t_ort, t_torch / t_ort))
+
+
+if __name__ == '__main__':
+    main()
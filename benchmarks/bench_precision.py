@@ -0,0 +1,76 @@
+""" CPU throughput of the WST model per --precision of train_vit_vtab.py (torch.autocast on CPU)
+
+For fp32 / fp16 / bf16: eval and train (adapter / head gradients) images per second, the dtype the DWT and
+IDWT ran in (with the fused haar WaveletBlock they are folded into the adapter linears) and how far the
+logits and gradients move from fp32. bf16 pays off on CPUs with AVX512-BF16 or AMX; without them the bf16
+kernels are emulated and slower than fp32.
+
+Run from the repo root:
+    python -m benchmarks.bench_precision --batch_size 16
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, make_trainable
+from models.vision_transformer import VisionTransformer
+
+DTYPES = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--iters', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--precision', nargs='+', default=list(DTYPES), choices=list(DTYPES))
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = make_trainable(VisionTransformer(num_classes=100, scale=10.))
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    x, target = torch.randn(args.batch_size, 3, 224, 224), torch.randint(0, 100, (args.batch_size,))
+
+    wave_dtypes = set()
+    for block in model.blocks:
+        for m in (block.waveblock.dwt, block.waveblock.idwt):
+            m.register_forward_hook(lambda m, inputs, output: wave_dtypes.add(output.dtype))
+
+    def train_step(dtype):
+        model.zero_grad(set_to_none=True)
+        with torch.autocast('cpu', dtype=dtype, enabled=dtype is not None):
+            loss = nn.CrossEntropyLoss()(model(x), target)
+        loss.backward()
+        return loss
+
+    ref = None
+    for precision in args.precision:
+        dtype = DTYPES[precision]
+        wave_dtypes.clear()
+        model.eval()
+        with torch.no_grad(), torch.autocast('cpu', dtype=dtype, enabled=dtype is not None):
+            logits = model(x).float()
+            t_eval = time_fn(lambda: model(x), args.iters)
+        model.train()
+        train_step(dtype)
+        grads = {n: p.grad.float() for n, p in model.named_parameters() if p.requires_grad}
+        t_train = time_fn(lambda: train_step(dtype), args.iters, warmup=1)
+        line = '{:5s} eval {:6.1f} img/s  train {:6.1f} img/s  dwt/idwt in {}'.format(
+            precision, args.batch_size / t_eval * 1e3, args.batch_size / t_train * 1e3,
+            ', '.join(sorted(str(d).replace('torch.', '') for d in wave_dtypes)) or 'the adapters (fused)')
+        if ref is None:
+            ref = logits, grads, t_eval, t_train
+        else:
+            err = (logits - ref[0]).abs().max().item()
+            grad_err = max(((g - ref[1][n]).norm() / ref[1][n].norm().clamp(min=1e-12)).item() for n, g in grads.items())
+            line += '  ({:.2f}x / {:.2f}x)  max logit err {:.2e}  grad rel err {:.2e}'.format(
+                ref[2] / t_eval, ref[3] / t_train, err, grad_err)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
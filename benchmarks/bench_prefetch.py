@@ -0,0 +1,82 @@
+""" PrefetchLoader on CPU: normalizing in a background thread vs inline before each step
+
+The dataset serves random uint8 CHW images (what the prefetcher path of create_transform produces) and each
+step is an eval forward of the WST model, so the time per batch shows how much of the uint8 -> float
+normalization is hidden behind compute. Also checks the normalized output and the channels_last layout.
+
+Run from the repo root:
+    python -m benchmarks.bench_prefetch --batch_size 32 --threads 4
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from models.vision_transformer import VisionTransformer
+from utils.utils import create_loader
+
+
+class RandomUint8(torch.utils.data.Dataset):
+    def __init__(self, num, img_size):
+        self.images = np.random.RandomState(0).randint(0, 256, (num, 3, img_size, img_size), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], index % 10
+
+
+def run(loader, step, prepare=None):
+    start = time.perf_counter()
+    for input, target in loader:
+        if prepare is not None:
+            input, target = prepare(input, target)
+        step(input)
+    return (time.perf_counter() - start) / len(loader) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_batches', type=int, default=6)
+    parser.add_argument('--img_size', type=int, default=224)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    dataset = RandomUint8(args.batch_size * args.num_batches, args.img_size)
+
+    def make_loader(channels_last=False):
+        return create_loader(dataset, args.batch_size, is_training=False, re_prob=0., use_prefetcher=True,
+                             num_workers=0, device='cpu', channels_last=channels_last)
+
+    for channels_last in (False, True):
+        input, target = next(iter(make_loader(channels_last)))
+        ref = (torch.from_numpy(dataset.images[:args.batch_size]).float() / 255 - 0.5) / 0.5
+        err = (input - ref).abs().max().item()
+        assert err < 1e-5 and torch.equal(target, torch.arange(args.batch_size) % 10)
+        assert input.is_contiguous(memory_format=torch.channels_last) == channels_last
+    print('normalization matches, channels_last layout ok')
+
+    model = VisionTransformer(num_classes=10).eval()
+
+    @torch.no_grad()
+    def step(input):
+        model(input)
+
+    loader = make_loader()
+    run(loader, step)  # warm up
+    # same loader, but the normalization runs in the consuming thread right before each step
+    t_inline = run(loader.loader, step, prepare=loader._preprocess)
+    t_thread = run(loader, step)
+    norm = run(loader.loader, lambda input: None, prepare=loader._preprocess)
+    print('bs {}  normalization alone: {:.1f} ms/batch'.format(args.batch_size, norm))
+    print('inline: {:.1f} ms/batch  background thread: {:.1f} ms/batch  ({:.2f}x)'.format(
+        t_inline, t_thread, t_inline / t_thread))
+
+
+if __name__ == '__main__':
+    main()
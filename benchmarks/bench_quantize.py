@@ -0,0 +1,83 @@
+""" Int8 backbone linears (models/quantization.py) vs fp32 on CPU
+
+For each --quantize mode: bytes of the Block linears, eval latency, train step latency (adapter / head
+gradients, straight-through through the int8 linears), and how far the outputs move from fp32: top-1
+agreement and max logit error on the eval batch, relative error of the trainable gradients.
+
+The backbone is randomly initialized unless --npz points at the pre-trained checkpoint, so the agreement is a
+proxy; the accuracy delta on a VTAB split comes from training with train_vit_vtab.py --quantize.
+
+Run from the repo root:
+    python -m benchmarks.bench_quantize --batch_size 8
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, make_trainable
+from models.quantization import Int8Linear, quantize_backbone
+from models.vision_transformer import VisionTransformer, create_pretrained
+
+
+def linear_mb(model):
+    n = 0
+    for block in model.blocks:
+        for m in (block.attn.qkv, block.attn.proj, block.mlp.fc1, block.mlp.fc2):
+            n += m.nbytes() if isinstance(m, Int8Linear) else sum(p.numel() * p.element_size() for p in m.parameters())
+    return n / 2 ** 20
+
+
+def trainable_grads(model, x, target):
+    model.zero_grad(set_to_none=True)
+    nn.CrossEntropyLoss()(model(x), target).backward()
+    return {n: p.grad.clone() for n, p in model.named_parameters() if p.requires_grad}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--iters', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--npz', default=None, type=str, help='pre-trained ViT-B/16 in21k checkpoint')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    if args.npz:
+        model = create_pretrained('vit_base_patch16_224_in21k', args.npz, num_classes=100, scale=10.)
+    else:
+        model = VisionTransformer(num_classes=100, scale=10.)
+    model = make_trainable(model)
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    x, target = torch.randn(args.batch_size, 3, 224, 224), torch.randint(0, 100, (args.batch_size,))
+
+    ref_logits = ref_grads = None
+    for mode in ('none', 'dynamic', 'weight'):
+        m = quantize_backbone(copy.deepcopy(model), mode)
+        m.eval()
+        with torch.no_grad():
+            logits = m(x)
+            t_eval = time_fn(lambda: m(x), args.iters)
+        m.train()
+        grads = trainable_grads(m, x, target)
+        t_train = time_fn(lambda: trainable_grads(m, x, target), args.iters, warmup=1)
+        line = '{:8s} linears {:6.1f} MB  eval {:8.1f} ms  train step {:8.1f} ms'.format(
+            mode, linear_mb(m), t_eval, t_train)
+        if ref_logits is None:
+            ref_logits, ref_grads, ref_eval, ref_train = logits, grads, t_eval, t_train
+        else:
+            agree = (logits.argmax(-1) == ref_logits.argmax(-1)).float().mean().item() * 100
+            err = (logits - ref_logits).abs().max().item()
+            grad_err = max(((g - ref_grads[n]).norm() / ref_grads[n].norm().clamp(min=1e-12)).item()
+                           for n, g in grads.items())
+            line += ' ({:.2f}x / {:.2f}x)  top-1 agreement {:5.1f}%  max logit err {:.2e}  grad rel err {:.2e}'.format(
+                ref_eval / t_eval, ref_train / t_train, agree, err, grad_err)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Resolution sweep for WST ViT-B/16: throughput and peak memory per input size
+
+Every resolution runs in its own process so the reported peak memory belongs to that size only.
+Weights are random, only speed and memory are measured.
+
+Run from the repo root:
+    python -m benchmarks.bench_resolution --img_size 160 192 224 384 --batch_size 32
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, peak_memory_mb, run_isolated, make_trainable
+from models.vision_transformer import VisionTransformer
+
+
+def run(img_size, batch_size, iters, threads, device):
+    if threads:
+        torch.set_num_threads(threads)
+    model = VisionTransformer(img_size=img_size, num_classes=100, r=2, scale=1.0)
+    make_trainable(model).to(device)
+    x = torch.randn(batch_size, 3, img_size, img_size, device=device)
+    target = torch.randint(0, 100, (batch_size,), device=device)
+    criterion = nn.CrossEntropyLoss()
+
+    def eval_step():
+        with torch.no_grad():
+            model(x)
+
+    def train_step():
+        loss = criterion(model(x), target)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    model.eval()
+    t_eval = time_fn(eval_step, iters, device=device)
+    mem_eval = peak_memory_mb(device)
+    model.train()
+    t_train = time_fn(train_step, iters, device=device)
+    mem_train = peak_memory_mb(device)
+    return dict(
+        img_size=img_size, tokens=model.patch_embed.num_patches,
+        eval_img_s=batch_size / t_eval * 1e3, train_img_s=batch_size / t_train * 1e3,
+        eval_peak_mb=mem_eval, train_peak_mb=mem_train)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_size', type=int, nargs='+', default=[160, 192, 224, 384])
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print('{:>8s} {:>7s} {:>12s} {:>12s} {:>14s} {:>14s}'.format(
+        'img_size', 'tokens', 'eval img/s', 'train img/s', 'eval peak MB', 'train peak MB'))
+    for img_size in args.img_size:
+        res = run_isolated(run, img_size, args.batch_size, args.iters, args.threads, args.device)
+        print('{img_size:>8d} {tokens:>7d} {eval_img_s:>12.1f} {train_img_s:>12.1f} '
+              '{eval_peak_mb:>14.0f} {train_peak_mb:>14.0f}'.format(**res))
+
+
+if __name__ == '__main__':
+    main()
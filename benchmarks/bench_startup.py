@@ -0,0 +1,113 @@
+""" Model startup: create_model with the .npz backbone, without and with the converted-weight cache and
+meta-device construction (create_pretrained)
+
+Writes a synthetic ViT-B/16 in21k checkpoint in the Flax .npz layout (same keys and shapes as the real one),
+then times create_model(..., checkpoint_path=npz) in fresh processes:
+  npz          _load_weights, numpy load + transpose + copy_ per tensor (the old path)
+  cache cold   first run with weight_cache_dir: hash, convert and save, then load
+  cache warm   later runs: memory-mapped torch load, the mapped tensors replace the random init (no copy)
+  meta ...     the same through create_pretrained: no random init of the backbone, the checkpoint tensors
+               become the parameters
+and checks that all of them end up with the same checkpoint weights. The randomly initialized tensors
+(small_patch_embed, adapters, head) are left out of that check: create_pretrained skips the backbone init, so
+under the same seed it draws other values for them than create_model.
+
+Run from the repo root:
+    python -m benchmarks.bench_startup
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.common import run_isolated, peak_memory_mb
+
+MODEL = 'vit_base_patch16_224_in21k'
+
+
+def write_npz(path, depth=12, dim=768, heads=12, num_classes=21843, seed=0):
+    rng = np.random.RandomState(seed)
+
+    def rand(*shape):
+        return rng.standard_normal(shape).astype(np.float32) * .02
+
+    w = {
+        'embedding/kernel': rand(16, 16, 3, dim), 'embedding/bias': rand(dim), 'cls': rand(1, 1, dim),
+        'Transformer/posembed_input/pos_embedding': rand(1, 197, dim),
+        'Transformer/encoder_norm/scale': rand(dim), 'Transformer/encoder_norm/bias': rand(dim),
+        'head/kernel': rand(dim, num_classes), 'head/bias': rand(num_classes),
+    }
+    for i in range(depth):
+        p = 'Transformer/encoderblock_{}/'.format(i)
+        for ln in ('LayerNorm_0', 'LayerNorm_2'):
+            w[p + ln + '/scale'], w[p + ln + '/bias'] = rand(dim), rand(dim)
+        for n in ('query', 'key', 'value'):
+            w[p + 'MultiHeadDotProductAttention_1/{}/kernel'.format(n)] = rand(dim, heads, dim // heads)
+            w[p + 'MultiHeadDotProductAttention_1/{}/bias'.format(n)] = rand(heads, dim // heads)
+        w[p + 'MultiHeadDotProductAttention_1/out/kernel'] = rand(heads, dim // heads, dim)
+        w[p + 'MultiHeadDotProductAttention_1/out/bias'] = rand(dim)
+        w[p + 'MlpBlock_3/Dense_0/kernel'], w[p + 'MlpBlock_3/Dense_0/bias'] = rand(dim, 4 * dim), rand(4 * dim)
+        w[p + 'MlpBlock_3/Dense_1/kernel'], w[p + 'MlpBlock_3/Dense_1/bias'] = rand(4 * dim, dim), rand(dim)
+    np.savez(path, **w)
+
+
+def startup(npz_path, kwargs, ref_path=None, meta=False):
+    """ create_model in this (fresh) process: seconds, peak RSS and, if ref_path is given, max diff to it
+    """
+    from timm.models import create_model
+    from models.vision_transformer import create_pretrained
+
+    start = time.perf_counter()
+    if meta:
+        model = create_pretrained(MODEL, npz_path, num_classes=10, **kwargs)
+    else:
+        model = create_model(MODEL, num_classes=10, checkpoint_path=npz_path, **kwargs)
+    seconds, mb = time.perf_counter() - start, peak_memory_mb()
+    assert not any(t.is_meta for t in model.state_dict().values())
+    state = {k: v for k, v in model.state_dict().items()
+             if not any(s in k for s in ('small_', 'adapter', 'head', 'dwt', 'idwt'))}
+    err = None
+    if ref_path is None:
+        torch.save(state, npz_path + '.ref.pt')
+    else:
+        ref = torch.load(ref_path)
+        assert ref.keys() == state.keys()
+        err = max((ref[k] - v).abs().max().item() for k, v in state.items())
+    return seconds, mb, err
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--npz', default=None, type=str, help='real checkpoint to use instead of a synthetic one')
+    parser.add_argument('--runs', type=int, default=3, help='warm runs to average')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        npz_path = args.npz or os.path.join(tmp, 'ViT-B_16.npz')
+        if args.npz is None:
+            write_npz(npz_path)
+        cache_dir = os.path.join(tmp, 'cache')
+        print('checkpoint {:.0f} MB'.format(os.path.getsize(npz_path) / 2 ** 20))
+
+        seconds, mb, _ = run_isolated(startup, npz_path, {})
+        print('{:12s} {:6.2f} s  peak {:6.0f} MB'.format('npz', seconds, mb))
+        ref_path = npz_path + '.ref.pt'
+        cases = [('cache cold', dict(weight_cache_dir=cache_dir), False)]
+        cases += [('cache warm', dict(weight_cache_dir=cache_dir), False)] * args.runs
+        cases += [('meta npz', {}, True)]
+        cases += [('meta cache', dict(weight_cache_dir=cache_dir), True)] * args.runs
+        for name, kwargs, meta in cases:
+            seconds, mb, err = run_isolated(startup, npz_path, kwargs, ref_path, meta)
+            assert err == 0, '{} loaded different weights ({})'.format(name, err)
+            print('{:12s} {:6.2f} s  peak {:6.0f} MB'.format(name, seconds, mb))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
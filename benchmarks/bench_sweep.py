@@ -0,0 +1,84 @@
+""" K-config sweep on one backbone (models/multiconfig.py) vs K separate models
+
+Checks that each stacked configuration produces the logits and gradients of a standalone model with the
+same adapters, then times one training step of the stack against K standalone steps on CPU.
+
+Run from the repo root:
+    python -m benchmarks.bench_sweep --num_configs 4 --batch_size 32
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, make_trainable
+from models.multiconfig import MultiConfigWST, SweepLoss
+from models.vision_transformer import VisionTransformer
+
+
+def standalone(backbone, sweep, k):
+    model = copy.deepcopy(backbone)
+    model.blocks = copy.deepcopy(sweep.backbone.blocks)
+    adapters = sweep.adapters[k]
+    model.small_patch_embed = copy.deepcopy(adapters.small_patch_embed)
+    model.head = copy.deepcopy(adapters.head)
+    for block, waveblock in zip(model.blocks, adapters.waveblocks):
+        block.waveblock = copy.deepcopy(waveblock)
+        block.scale = adapters.scale
+    return make_trainable(model)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_configs', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    backbone = VisionTransformer(num_classes=10)
+    configs = [dict(r=2 + k % 3, scale=1. + k, lr=1e-3, weight_decay=5e-2, drop_path=0.) for k in range(args.num_configs)]
+    sweep = MultiConfigWST(copy.deepcopy(backbone), configs)
+    for adapters in sweep.adapters:
+        for waveblock in adapters.waveblocks:
+            nn.init.normal_(waveblock.adapter_up.bias, std=.02)
+    models = [standalone(backbone, sweep, k) for k in range(args.num_configs)]
+
+    criterion = nn.CrossEntropyLoss()
+    x, target = torch.randn(4, 3, 224, 224), torch.randint(0, 10, (4,))
+    out = sweep(x)
+    SweepLoss(criterion)(out, target).backward()
+    for k, model in enumerate(models):
+        ref = model(x)
+        criterion(ref, target).backward()
+        err = (out[k] - ref).abs().max().item()
+        grad_err = (sweep.adapters[k].head.weight.grad - model.head.weight.grad).abs().max().item()
+        grad_err = max(grad_err, (sweep.adapters[k].waveblocks[0].adapter_down.weight.grad
+                                  - model.blocks[0].waveblock.adapter_down.weight.grad).abs().max().item())
+        print('parity config {}: logits {:.2e}  grads {:.2e}'.format(k, err, grad_err))
+        assert err < 1e-4 and grad_err < 1e-4
+
+    x, target = torch.randn(args.batch_size, 3, 224, 224), torch.randint(0, 10, (args.batch_size,))
+    sweep_loss = SweepLoss(criterion)
+
+    def sweep_step():
+        sweep_loss(sweep(x), target).backward()
+        sweep.zero_grad(set_to_none=True)
+
+    def separate_steps():
+        for model in models:
+            criterion(model(x), target).backward()
+            model.zero_grad(set_to_none=True)
+
+    t_sweep = time_fn(sweep_step, args.iters, warmup=1)
+    t_separate = time_fn(separate_steps, args.iters, warmup=1)
+    print('K={} bs={}  stacked: {:.0f} ms/step  separate: {:.0f} ms/step  ({:.2f}x)'.format(
+        args.num_configs, args.batch_size, t_sweep, t_separate, t_separate / t_sweep))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+""" Micro-benchmark for the DWT/IDWT modules in wave.py
+
+Compares the grouped-convolution path against the closed-form Haar path on CPU, using the
+shapes a WaveletBlock sees for ViT-B/16 at 224px (small_x: B x 192 x 28 x 28).
+Outputs and input gradients of both paths are checked against each other before timing.
+
+Run from the repo root:
+    python -m benchmarks.bench_wave --batch_size 32 256
+"""
+import argparse
+from contextlib import suppress
+from functools import partial
+
+import torch
+
+import wave
+from benchmarks.common import time_fn
+
+
+def _make_pair(fast):
+    dwt = wave.DWT_2D('haar', fast=fast)
+    idwt = wave.IDWT_2D('haar', fast=fast)
+    return dwt, idwt
+
+
+def check_parity(batch_size, dim, size):
+    conv_dwt, conv_idwt = _make_pair(fast=False)
+    fast_dwt, fast_idwt = _make_pair(fast=True)
+
+    x = torch.randn(batch_size, size, size, dim).permute(0, 3, 1, 2)
+    x_conv = x.clone().requires_grad_(True)
+    x_fast = x.clone().requires_grad_(True)
+    grad = torch.randn(batch_size, 4 * dim, size // 2, size // 2)
+
+    y_conv, y_fast = conv_dwt(x_conv), fast_dwt(x_fast)
+    (y_conv * grad).sum().backward()
+    (y_fast * grad).sum().backward()
+    dwt_err = (y_conv - y_fast).abs().max().item()
+    dwt_grad_err = (x_conv.grad - x_fast.grad).abs().max().item()
+
+    z = grad.clone()
+    z_conv = z.clone().requires_grad_(True)
+    z_fast = z.clone().requires_grad_(True)
+    out_conv, out_fast = conv_idwt(z_conv), fast_idwt(z_fast)
+    (out_conv * x).sum().backward()
+    (out_fast * x).sum().backward()
+    idwt_err = (out_conv - out_fast).abs().max().item()
+    idwt_grad_err = (z_conv.grad - z_fast.grad).abs().max().item()
+
+    print('parity  dwt: {:.2e} (grad {:.2e})  idwt: {:.2e} (grad {:.2e})'.format(
+        dwt_err, dwt_grad_err, idwt_err, idwt_grad_err))
+    assert max(dwt_err, dwt_grad_err, idwt_err, idwt_grad_err) < 1e-5
+    # round trip must be lossless
+    assert torch.allclose(fast_idwt(fast_dwt(x)), x, atol=1e-5)
+
+
+def check_precision(batch_size, dim, size):
+    """ Both paths must run in fp32, under bf16 autocast and in fp16, keeping the buffers in fp32.
+    """
+    x = torch.randn(batch_size, dim, size, size)
+    for fast in (False, True):
+        dwt, idwt = _make_pair(fast)
+        modes = (
+            ('fp32', torch.float32, suppress, x),
+            ('bf16 autocast', torch.bfloat16, partial(torch.autocast, 'cpu', dtype=torch.bfloat16), x),
+            ('fp16', torch.float16, suppress, x.half()),
+        )
+        for name, dtype, autocast, inp in modes:
+            with autocast():
+                out = idwt(dwt(inp))
+            assert out.dtype == dtype, (name, out.dtype)
+            err = (out.float() - x).abs().max().item()
+            print('precision {:<4s} {:<14s} round trip err: {:.2e}'.format('haar' if fast else 'conv', name, err))
+            assert err < 0.1
+        assert dwt.w_ll.dtype == idwt.filters.dtype == torch.float32
+        if not fast:
+            # cast filters are cached, the second call must not copy again
+            assert dwt.cast_filters(torch.bfloat16, x.device)[0] is dwt.cast_filters(torch.bfloat16, x.device)[0]
+
+
+def bench(batch_size, dim, size, iters):
+    results = {}
+    for name, fast in (('conv', False), ('haar', True)):
+        dwt, idwt = _make_pair(fast)
+        x = torch.randn(batch_size, size, size, dim).permute(0, 3, 1, 2)
+        x_grad = x.clone().requires_grad_(True)
+
+        def fwd():
+            with torch.no_grad():
+                idwt(dwt(x))
+
+        def fwd_bwd():
+            idwt(dwt(x_grad)).sum().backward()
+
+        results[name] = (time_fn(fwd, iters, warmup=3), time_fn(fwd_bwd, iters, warmup=3))
+
+    for name, (t_fwd, t_fwd_bwd) in results.items():
+        print('bs {:>4d}  {:<5s} fwd: {:8.2f} ms  fwd+bwd: {:8.2f} ms'.format(batch_size, name, t_fwd, t_fwd_bwd))
+    speedup_fwd = results['conv'][0] / results['haar'][0]
+    speedup_bwd = results['conv'][1] / results['haar'][1]
+    print('bs {:>4d}  speedup fwd: {:.2f}x  fwd+bwd: {:.2f}x'.format(batch_size, speedup_fwd, speedup_bwd))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[32])
+    parser.add_argument('--dim', type=int, default=192)
+    parser.add_argument('--size', type=int, default=28)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    check_parity(4, args.dim, args.size)
+    check_precision(4, args.dim, args.size)
+    for batch_size in args.batch_size:
+        bench(batch_size, args.dim, args.size, args.iters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" WaveletBlock: fused token-layout path (forward_fused) vs the NCHW DWT -> adapter -> IDWT chain
+
+Shapes of ViT-B/16 at 224px (x: B x 197 x 768, small_x: B x 784 x 192), the small_x input as the small patch
+embedding hands it over (a transposed view). Checks outputs and gradients of both paths against each other,
+also with adapters of another width swapped in after construction (as bench_multitask does), then times eval
+forward and forward + backward (adapter weights and inputs).
+
+Run from the repo root:
+    python -m benchmarks.bench_waveblock --batch_size 32 256
+"""
+import argparse
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn
+from models.vision_transformer import WaveletBlock
+
+
+def run(block, fused, x, small_x, backward):
+    block.fused = fused
+    wave_x, small_out = block(x, small_x)
+    if backward:
+        (wave_x.square().mean() + small_out.square().mean()).backward()
+    return wave_x, small_out
+
+
+def parity(block, x, small_x):
+    """ Max abs output difference and max relative gradient difference of the fused and unfused path
+    """
+    outs, grads = [], []
+    for fused in (False, True):
+        for t in (x, small_x, *block.parameters()):
+            t.grad = None
+        outs.append(run(block, fused, x, small_x, backward=True))
+        grads.append([t.grad.clone() for t in (x, small_x, *block.parameters())])
+    out_err = max((a - b).abs().max().item() for a, b in zip(*outs))
+    grad_err = max(((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item() for a, b in zip(*grads))
+    assert out_err < 1e-4 and grad_err < 1e-4, (out_err, grad_err)
+    return out_err, grad_err
+
+
+def inputs(bs):
+    x = torch.randn(bs, 197, 768, requires_grad=True)
+    small_x = torch.randn(bs, 192, 784).transpose(1, 2).requires_grad_(True)
+    return x, small_x
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[32, 256])
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    resized = WaveletBlock(768, args.r)
+    resized.adapter_down, resized.adapter_up = nn.Linear(768, 3 * args.r), nn.Linear(3 * args.r, 768)
+    nn.init.normal_(resized.adapter_up.bias, std=.02)
+    print('adapters resized to r {}: max abs diff {:.1e}'.format(3 * args.r, max(parity(resized, *inputs(2)))))
+
+    block = WaveletBlock(768, args.r)
+    nn.init.normal_(block.adapter_up.bias, std=.02)
+    for bs in args.batch_size:
+        x, small_x = inputs(bs)
+        out_err, grad_err = parity(block, x, small_x)
+
+        t = {}
+        for fused in (False, True):
+            with torch.no_grad():
+                t['eval', fused] = time_fn(lambda: run(block, fused, x, small_x, False), args.iters)
+            t['train', fused] = time_fn(lambda: run(block, fused, x, small_x, True), args.iters)
+        print('bs {:3d}  max abs diff {:.1e}  eval: {:7.1f} -> {:7.1f} ms ({:.2f}x)  fwd+bwd: {:7.1f} -> {:7.1f} ms ({:.2f}x)'
+              .format(bs, max(out_err, grad_err), t['eval', False], t['eval', True], t['eval', False] / t['eval', True],
+                      t['train', False], t['train', True], t['train', False] / t['train', True]))
+
+
+if __name__ == '__main__':
+    main()
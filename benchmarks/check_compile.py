@@ -0,0 +1,53 @@
+""" torch.compile of the WST model on CPU: one graph, same outputs as eager
+
+fullgraph=True makes any graph break an error, so this fails if VisionTransformer.forward stops being
+capturable. Checks eval logits and the adapter / head gradients of a training step against eager.
+
+Run from the repo root:
+    python -m benchmarks.check_compile
+"""
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import make_trainable
+from models.vision_transformer import VisionTransformer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=12)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--attn_backend', default='eager')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = make_trainable(VisionTransformer(num_classes=10, depth=args.depth, attn_backend=args.attn_backend))
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    compiled_model = copy.deepcopy(model)
+    compiled = torch.compile(compiled_model, fullgraph=True)
+    x, target = torch.randn(args.batch_size, 3, 224, 224), torch.randint(0, 10, (args.batch_size,))
+
+    model.eval(), compiled.eval()
+    with torch.no_grad():
+        err = (compiled(x) - model(x)).abs().max().item()
+    print('eval logits, compiled vs eager: {:.2e}'.format(err))
+    assert err < 1e-4
+
+    model.train(), compiled.train()
+    criterion = nn.CrossEntropyLoss()
+    criterion(model(x), target).backward()
+    criterion(compiled(x), target).backward()
+    grad_err = 0.
+    for (n, p), p_c in zip(model.named_parameters(), compiled_model.parameters()):
+        if p.grad is not None:
+            grad_err = max(grad_err, ((p_c.grad - p.grad).abs().max() / p.grad.abs().max().clamp(min=1e-12)).item())
+    print('train gradients, compiled vs eager (relative): {:.2e}'.format(grad_err))
+    assert grad_err < 1e-3
+
+
+if __name__ == '__main__':
+    main()
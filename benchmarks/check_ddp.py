@@ -0,0 +1,88 @@
+""" Distributed training as train_vit_vtab.py sets it up (gloo, DDP ignoring the frozen backbone), on CPU
+
+Spawns --world_size processes that each run a training step on their shard of one batch, checks the
+all-reduced adapter / small-embed / head gradients against a single-process step on the whole batch and
+reports how many bytes the gradient all-reduce sends compared to the model size.
+
+Run from the repo root:
+    python -m benchmarks.check_ddp --world_size 2
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from benchmarks.common import make_trainable
+from models.vision_transformer import VisionTransformer
+
+
+def build(depth):
+    torch.manual_seed(0)
+    model = make_trainable(VisionTransformer(num_classes=10, depth=depth))
+    for block in model.blocks:
+        nn.init.normal_(block.waveblock.adapter_up.bias, std=.02)
+    return model
+
+
+def batch(batch_size):
+    generator = torch.Generator().manual_seed(1)
+    return torch.randn(batch_size, 3, 224, 224, generator=generator), torch.randint(0, 10, (batch_size,),
+                                                                                      generator=generator)
+
+
+def worker(rank, world_size, init_file, depth, batch_size, out):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    model = build(depth)
+    frozen = [n for n, p in model.named_parameters() if not p.requires_grad]
+    DDP._set_params_and_buffers_to_ignore_for_model(model, frozen + [n for n, _ in model.named_buffers()])
+    ddp = DDP(model, broadcast_buffers=False)
+    sent = []
+
+    def counting_hook(state, bucket):
+        sent.append(bucket.buffer().numel() * bucket.buffer().element_size())
+        return allreduce_hook(state, bucket)
+
+    ddp.register_comm_hook(None, counting_hook)
+    x, target = batch(batch_size)
+    nn.CrossEntropyLoss()(ddp(x[rank::world_size]), target[rank::world_size]).backward()
+    if rank == 0:
+        torch.save(({n: p.grad for n, p in model.named_parameters() if p.requires_grad}, sum(sent)), out)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world_size', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=4)
+    args = parser.parse_args()
+    assert args.batch_size % args.world_size == 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'grads.pt')
+        mp.spawn(worker, args=(args.world_size, os.path.join(tmp, 'init'), args.depth, args.batch_size, out),
+                 nprocs=args.world_size)
+        grads, sent = torch.load(out)
+
+    model = build(args.depth)
+    x, target = batch(args.batch_size)
+    nn.CrossEntropyLoss()(model(x), target).backward()
+    err = max(((grads[n] - p.grad).abs().max() / p.grad.abs().max().clamp(min=1e-12)).item()
+              for n, p in model.named_parameters() if p.requires_grad)
+    trainable = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    print('gradients, {} processes vs one (relative): {:.2e}'.format(args.world_size, err))
+    print('all-reduced per step: {:.2f} MB (trainable {:.2f} MB, model {:.1f} MB)'.format(
+        sent / 2 ** 20, trainable / 2 ** 20, total / 2 ** 20))
+    assert err < 1e-4
+    assert sent == trainable
+
+
+if __name__ == '__main__':
+    main()
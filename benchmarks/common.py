@@ -0,0 +1,46 @@
+""" Shared helpers for the scripts in benchmarks/
+"""
+import multiprocessing
+import resource
+import time
+
+import torch
+
+
+def time_fn(fn, iters, warmup=2, device='cpu'):
+    """ Average wall time of fn() in ms
+    """
+    for _ in range(warmup):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def peak_memory_mb(device='cpu'):
+    """ Peak memory of this process so far: allocator high-water mark on CUDA, max RSS on CPU
+    """
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def run_isolated(fn, *args):
+    """ Run fn(*args) in a fresh process so that its peak RSS is not polluted by earlier runs
+    """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(fn, args)
+
+
+def make_trainable(model):
+    """ Same split as mark_trainable_parameters in train_vit_vtab.py
+    """
+    for n, p in model.named_parameters():
+        p.requires_grad = 'adapter' in n or 'small_' in n or n.startswith('head')
+    return model
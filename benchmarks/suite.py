@@ -0,0 +1,132 @@
+""" Benchmark suite: WST ViT-B/16 throughput and memory on CPU, written to JSON to diff across commits
+
+Builds vit_base_patch16_224_in21k through the timm registry (WST blocks, random weights) and times, on
+synthetic inputs, for every batch size x precision x thread count:
+  eval        forward under torch.no_grad
+  train       forward + backward, gradients only for the trainable adapter / small-embed / head parameters
+  dwt_idwt    the DWT_2D and IDWT_2D modules alone on the small_x grid of one block (B x 192 x 28 x 28),
+              forward + backward
+Each case runs in a fresh process so that its peak RSS is its own: peak_rss_mb is the process peak,
+peak_delta_mb the part above the model and inputs (activations, workspace).
+
+Run from the repo root:
+    python -m benchmarks.suite --batch_size 1 8 32 --precision fp32 bf16 --threads 1 4 --output bench.json
+    python -m benchmarks.suite ... --compare bench_before.json   # ratios against an earlier run
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+
+import torch
+import torch.nn as nn
+
+from benchmarks.common import time_fn, peak_memory_mb, run_isolated, make_trainable
+
+MODEL = 'vit_base_patch16_224_in21k'
+CASES = ('eval', 'train', 'dwt_idwt')
+DTYPES = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def run_case(case, batch_size, precision, threads, iters):
+    """ One measurement in this (fresh) process, returns the JSON record
+    """
+    from timm.models import create_model
+    import wave
+    from models import vision_transformer  # registers the WST models with timm
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    dtype = DTYPES[precision]
+
+    def autocast():
+        return torch.autocast('cpu', dtype=dtype, enabled=dtype is not None)
+
+    if case == 'dwt_idwt':
+        dwt, idwt = wave.DWT_2D('haar'), wave.IDWT_2D('haar')
+        x = torch.randn(batch_size, 28, 28, 192).permute(0, 3, 1, 2).requires_grad_(True)
+
+        def step():
+            with autocast():
+                out = idwt(dwt(x))
+            out.float().sum().backward()
+    else:
+        model = make_trainable(create_model(MODEL, num_classes=100))
+        x, target = torch.randn(batch_size, 3, 224, 224), torch.randint(0, 100, (batch_size,))
+        criterion = nn.CrossEntropyLoss()
+        if case == 'eval':
+            model.eval()
+
+            def step():
+                with torch.no_grad(), autocast():
+                    model(x)
+        else:
+            model.train()
+
+            def step():
+                model.zero_grad(set_to_none=True)
+                with autocast():
+                    loss = criterion(model(x), target)
+                loss.backward()
+
+    baseline = peak_memory_mb()
+    ms = time_fn(step, iters, warmup=1)
+    peak = peak_memory_mb()
+    return dict(case=case, batch_size=batch_size, precision=precision, threads=threads, iters=iters,
+                ms_per_iter=round(ms, 3), images_per_s=round(batch_size / ms * 1e3, 3),
+                peak_rss_mb=round(peak, 1), peak_delta_mb=round(peak - baseline, 1))
+
+
+def environment():
+    import timm
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(date=datetime.datetime.now().isoformat(timespec='seconds'), commit=commit,
+                torch=torch.__version__, timm=timm.__version__, python=platform.python_version(),
+                cpu=platform.processor() or platform.machine(), default_threads=torch.get_num_threads())
+
+
+def key(result):
+    return result['case'], result['batch_size'], result['precision'], result['threads']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--precision', nargs='+', default=['fp32', 'bf16'], choices=list(DTYPES))
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=CASES)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json', type=str)
+    parser.add_argument('--compare', default=None, type=str, help='JSON of an earlier run to print speedups against')
+    args = parser.parse_args()
+
+    before = {}
+    if args.compare:
+        with open(args.compare) as f:
+            before = {key(r): r for r in json.load(f)['results']}
+
+    results = []
+    for threads in args.threads:
+        for precision in args.precision:
+            for case in args.cases:
+                for batch_size in args.batch_size:
+                    r = run_isolated(run_case, case, batch_size, precision, threads, args.iters)
+                    results.append(r)
+                    line = '{case:8s} bs {batch_size:3d} {precision:4s} threads {threads:2d}  {images_per_s:9.2f} img/s' \
+                           '  {ms_per_iter:9.1f} ms  peak {peak_rss_mb:7.0f} MB (+{peak_delta_mb:.0f})'.format(**r)
+                    if key(r) in before:
+                        line += '  {:.2f}x vs {}'.format(r['images_per_s'] / before[key(r)]['images_per_s'], args.compare)
+                    print(line, flush=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(environment=environment(), results=results), f, indent=1)
+    print('wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
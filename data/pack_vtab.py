@@ -0,0 +1,44 @@
+""" One-time conversion of VTAB-1k splits into memory-mapped shards read by data.vtab.VTABShard
+
+    python -m data.pack_vtab --data_dir /path/to/vtab-1k --out_dir /path/to/vtab-1k-shards \
+        --dataset sun397 patch_camelyon svhn dmlab --splits train_val test
+
+Train with the shards through `train_vit_vtab.py --shard_dir /path/to/vtab-1k-shards`.
+"""
+import argparse
+import os
+import time
+
+from data.vtab import VTAB, shard_path, write_shard
+from utils.utils import create_transform, write
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', required=True, type=str, help='vtab-1k root')
+    parser.add_argument('--out_dir', required=True, type=str, help='directory for the shard files')
+    parser.add_argument('--dataset', nargs='+', required=True, type=str)
+    parser.add_argument('--splits', nargs='+', default=['train_val', 'test'],
+                        choices=['train_val', 'train', 'val', 'test'])
+    parser.add_argument('--img_size', type=int, default=224)
+    parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--overwrite', default=False, action='store_true')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    transform = create_transform(True, aug_type='VTAB', img_size=args.img_size)
+    for dataset in args.dataset:
+        for split in args.splits:
+            path = shard_path(args.out_dir, dataset, split)
+            if os.path.exists(path) and not args.overwrite:
+                write('{} exists, skipping'.format(path))
+                continue
+            start = time.time()
+            vtab = VTAB(root=args.data_dir, dataset=dataset, split_=split, transform=transform)
+            write_shard(path, vtab, num_workers=args.num_workers)
+            write('{}: {} samples, {:.1f} MB in {:.1f}s'.format(
+                path, len(vtab.samples), os.path.getsize(path) / 2 ** 20, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,92 @@
 import os
+import hashlib
+import json
+from collections.abc import Sequence
 
+import numpy as np
+import torch
+from torchvision import transforms
 from torchvision.datasets.folder import ImageFolder, default_loader
 
+# transforms with the same output in every epoch, everything up to the first other transform can be cached
+CACHEABLE_TRANSFORMS = (transforms.Resize, transforms.CenterCrop)
+
+
+class Uint8ToTensor:
+    """ Cached uint8 CHW array -> float tensor in [0, 1], what ToTensor does on the PIL image
+    """
+
+    def __call__(self, np_img):
+        return torch.from_numpy(np_img).float().div_(255)
+
+
+def to_uint8_chw(pil_img):
+    np_img = np.array(pil_img, dtype=np.uint8)
+    if np_img.ndim < 3:
+        np_img = np.expand_dims(np_img, axis=-1)
+    return np.ascontiguousarray(np.rollaxis(np_img, 2))  # HWC to CHW
+
+
+def split_transform(transform):
+    """ Split transform into the cacheable image part and the rest, applied on the cached uint8 CHW arrays.
+
+    Returns (None, None) if nothing deterministic can be cached.
+    """
+    from utils.utils import ToNumpy
+
+    tfl = list(transform.transforms) if isinstance(transform, transforms.Compose) else [transform]
+    n = 0
+    while n < len(tfl) and isinstance(tfl[n], CACHEABLE_TRANSFORMS):
+        n += 1
+    rest = tfl[n:]
+    if n == 0 or not rest:
+        return None, None
+    if isinstance(rest[0], ToNumpy):
+        rest = rest[1:]
+    elif isinstance(rest[0], transforms.ToTensor):
+        rest = [Uint8ToTensor()] + rest[1:]
+    else:
+        return None, None
+    return transforms.Compose(tfl[:n]), transforms.Compose(rest)
+
+
+class ContiguousBatch(Sequence):
+    """ A batch of samples already stacked into one (B, C, H, W) uint8 array.
+
+    FastCollate takes the array as is, anything else sees the usual sequence of (image, target) pairs.
+    """
+
+    def __init__(self, images, targets):
+        self.images = images
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], self.targets[index]
+
+
+class _DecodeDataset(torch.utils.data.Dataset):
+    def __init__(self, samples, loader, transform):
+        self.samples = samples
+        self.loader = loader
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return to_uint8_chw(self.transform(self.loader(self.samples[index][0])))
+
+
 class VTAB(ImageFolder):
-    def __init__(self, root, dataset, split_, transform):
+    def __init__(self, root, dataset, split_, transform, cache=None, cache_dir='cache', cache_workers=8):
+        """
+        cache: None, 'ram' or 'disk'. Decodes every image once and keeps the output of the deterministic
+            part of transform as uint8 CHW, in memory or in an .npy file in cache_dir that is reused by
+            later runs. The file is keyed by dataset, split, list file contents and transform.
+        """
 
         self.loader = default_loader
         self.target_transform = None
@@ -36,4 +119,142 @@ class VTAB(ImageFolder):
             for line in f:
                 img_name = line.split(' ')[0]
                 label = int(line.split(' ')[1])
-                self.samples.append((os.path.join(self.dataset_root, img_name), label))
\ No newline at end of file
+                self.samples.append((os.path.join(self.dataset_root, img_name), label))
+
+        self.cache = None
+        if cache is not None:
+            assert cache in ('ram', 'disk')
+            cache_transform, self.post_transform = split_transform(transform)
+            if cache_transform is None:
+                raise ValueError('transform has no deterministic part that can be cached: {}'.format(transform))
+            if cache == 'ram':
+                self.cache = self._decode_all(cache_transform, cache_workers)
+            else:
+                self.cache = self._load_disk_cache(
+                    cache_dir, '{}_{}'.format(dataset, split_), list_path, cache_transform, cache_workers)
+
+    def _decode_all(self, cache_transform, num_workers, out=None):
+        loader = torch.utils.data.DataLoader(
+            _DecodeDataset(self.samples, self.loader, cache_transform), batch_size=None, num_workers=num_workers)
+        for i, img in enumerate(loader):
+            if out is None:
+                out = np.empty((len(self.samples),) + tuple(img.shape), dtype=np.uint8)
+            out[i] = img
+        return out
+
+    def _load_disk_cache(self, cache_dir, name, list_path, cache_transform, num_workers):
+        key = hashlib.sha1()
+        with open(list_path, 'rb') as f:
+            key.update(f.read())
+        key.update(repr(cache_transform).encode())
+        path = os.path.join(cache_dir, '{}_{}.npy'.format(name, key.hexdigest()[:16]))
+
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            shape = to_uint8_chw(cache_transform(self.loader(self.samples[0][0]))).shape
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(self.samples),) + shape)
+            self._decode_all(cache_transform, num_workers, out=out)
+            out.flush()
+            del out
+            if os.path.exists(path):
+                os.remove(tmp_path)  # a concurrent run published the same cache first
+            else:
+                os.replace(tmp_path, path)
+        # copy-on-write mapping: writable views for torch.from_numpy, nothing is written back
+        return np.load(path, mmap_mode='c')
+
+    def __getitem__(self, index):
+        if self.cache is None:
+            return super().__getitem__(index)
+        sample = self.post_transform(self.cache[index])
+        return sample, self.samples[index][1]
+
+    def __getitems__(self, indices):
+        """ Batched fetch for the DataLoader: when the cached images need no further transform (the prefetcher
+        path) the whole batch is gathered from the cache in one indexing op.
+        """
+        if self.cache is None or self.post_transform.transforms:
+            return [self[index] for index in indices]
+        return ContiguousBatch(self.cache[indices], [self.samples[index][1] for index in indices])
+
+
+SHARD_MAGIC = b'VTABSHRD'
+SHARD_ALIGN = 4096
+
+
+def shard_path(root, dataset, split_):
+    return os.path.join(root, '{}_{}.shard'.format(dataset, split_))
+
+
+def read_shard_header(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(SHARD_MAGIC))
+        assert magic == SHARD_MAGIC, '{} is not a VTAB shard'.format(path)
+        header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        return json.loads(f.read(header_len).decode())
+
+
+def write_shard(path, dataset, num_workers=8):
+    """ Write a VTAB dataset (with a cacheable transform) to one contiguous file:
+    magic | header length | json header | images (N, C, H, W) uint8 | labels (N,) int64,
+    with the image and label blocks aligned to SHARD_ALIGN. The header holds the index (shapes, offsets,
+    sample names) and the repr of the transform the images went through.
+    """
+    cache_transform, _ = split_transform(dataset.transform)
+    if cache_transform is None:
+        raise ValueError('transform has no deterministic part that can be packed: {}'.format(dataset.transform))
+    num = len(dataset.samples)
+    shape = to_uint8_chw(cache_transform(dataset.loader(dataset.samples[0][0]))).shape
+    names = [os.path.relpath(p, dataset.dataset_root) for p, _ in dataset.samples]
+
+    def _align(n):
+        return (n + SHARD_ALIGN - 1) // SHARD_ALIGN * SHARD_ALIGN
+
+    header = dict(num=num, shape=list(shape), transform=repr(cache_transform), names=names)
+    # the offsets go into the header as well, reserve room for them when sizing it
+    start = _align(len(SHARD_MAGIC) + 8 + len(json.dumps(header)) + 128)
+    header.update(images_offset=start, labels_offset=_align(start + num * int(np.prod(shape))))
+    header_bytes = json.dumps(header).encode()
+    assert len(SHARD_MAGIC) + 8 + len(header_bytes) <= start
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SHARD_MAGIC)
+        f.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        f.write(header_bytes)
+        f.truncate(header['labels_offset'] + num * 8)
+    images = np.memmap(tmp_path, dtype=np.uint8, mode='r+', offset=header['images_offset'], shape=(num,) + shape)
+    dataset._decode_all(cache_transform, num_workers, out=images)
+    images.flush()
+    del images
+    labels = np.memmap(tmp_path, dtype='<i8', mode='r+', offset=header['labels_offset'], shape=(num,))
+    labels[:] = [label for _, label in dataset.samples]
+    labels.flush()
+    del labels
+    os.replace(tmp_path, path)
+
+
+class VTABShard(VTAB):
+    """ Drop-in for VTAB that serves samples from a shard written by write_shard (see data/pack_vtab.py).
+
+    Images are views into an np.memmap of the shard, so reading a split is one sequential file instead of
+    one filesystem hit per sample.
+    """
+    def __init__(self, root, dataset, split_, transform, **kwargs):
+        path = shard_path(root, dataset, split_)
+        header = read_shard_header(path)
+        cache_transform, self.post_transform = split_transform(transform)
+        if cache_transform is None or repr(cache_transform) != header['transform']:
+            raise ValueError('{} was packed with {}, which does not match {}'.format(
+                path, header['transform'], transform))
+
+        self.loader = None
+        self.target_transform = None
+        self.transform = transform
+        self.dataset_root = root
+        num, shape = header['num'], tuple(header['shape'])
+        # copy-on-write mapping: writable views for torch.from_numpy, nothing is written back
+        self.cache = np.memmap(path, dtype=np.uint8, mode='c', offset=header['images_offset'], shape=(num,) + shape)
+        self.labels = np.memmap(path, dtype='<i8', mode='r', offset=header['labels_offset'], shape=(num,))
+        self.samples = [(name, int(label)) for name, label in zip(header['names'], self.labels)]
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+""" Export a trained WST checkpoint as a deployable inference artifact
+
+    python export.py --load_path /path/to/Vit-B_16.npz \
+        --checkpoint checkpoint/vit_base_patch16_224_in21k/VTAB/dtd/.../best_save_model.pt \
+        --scale 0.1 --format torchscript --output dtd_wst.pt
+
+formats:
+  torchscript  torch.jit.trace + freeze, load with torch.jit.load
+  export       torch.export program (.pt2) with a dynamic batch dimension, load with torch.export.load(...).module()
+  onnx         ONNX graph (opset --opset) with a dynamic batch dimension, the haar DWT/IDWT become Slice/Add/Sub
+               (Conv/ConvTranspose for other wavelets); checked with onnxruntime, which needs to be installed
+
+The merged inference module (models/inference.py) is exported unless --no_merge is given. The artifact is
+loaded back and compared against the eager model before the command returns.
+"""
+import argparse
+import inspect
+import time
+
+import torch
+from timm.models import create_model
+
+from models import vision_transformer  # also registers the WST models with timm
+from models.inference import merge_for_inference
+from utils.utils import write
+
+FORMATS = ('torchscript', 'export', 'onnx')
+
+
+def build_model(args):
+    """ Backbone from the .npz weights plus the trainable tensors util.save wrote, in eval mode
+    """
+    state = torch.load(args.checkpoint, map_location='cpu') if args.checkpoint else {}
+    num_classes = state['head.weight'].shape[0] if 'head.weight' in state else args.num_classes
+    r = state['blocks.0.waveblock.adapter_down.weight'].shape[0] if state else args.r
+    assert num_classes is not None, '--num_classes is needed without --checkpoint'
+    if args.load_path:
+        model = vision_transformer.create_pretrained(args.model, args.load_path, num_classes=num_classes,
+                                                     r=r, scale=args.scale, img_size=args.img_size)
+    else:
+        model = create_model(args.model, num_classes=num_classes, r=r, scale=args.scale, img_size=args.img_size)
+    if state:
+        missing, unexpected = model.load_state_dict(state, strict=False)
+        assert not unexpected, 'unexpected keys in {}: {}'.format(args.checkpoint, unexpected)
+    model.eval()
+    return model if args.no_merge else merge_for_inference(model)
+
+
+def export_onnx(module, example, output, opset=17):
+    kwargs = dict(input_names=['input'], output_names=['logits'],
+                  dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=opset)
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False  # the TorchScript-based exporter handles the dynamic batch of this model
+    torch.onnx.export(module, (example,), output, **kwargs)
+
+
+class OnnxRuntimeModule:
+    """ Runs an exported .onnx file on the onnxruntime CPU provider, called like the torch module
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {'input': x.cpu().numpy()})[0])
+
+
+@torch.no_grad()
+def export(module, example, fmt, output, opset=17):
+    if fmt == 'torchscript':
+        artifact = torch.jit.freeze(torch.jit.trace(module, example))
+        torch.jit.save(artifact, output)
+        return torch.jit.load(output)
+    elif fmt == 'export':
+        batch = torch.export.Dim('batch', min=1, max=1024)
+        program = torch.export.export(module, (example,), dynamic_shapes=({0: batch},))
+        torch.export.save(program, output)
+        return torch.export.load(output).module()
+    elif fmt == 'onnx':
+        export_onnx(module, example, output, opset=opset)
+        return OnnxRuntimeModule(output)
+    raise NotImplementedError(fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='vit_base_patch16_224_in21k', type=str)
+    parser.add_argument('--load_path', default=None, type=str, help='pre-trained backbone (.npz)')
+    parser.add_argument('--checkpoint', default=None, type=str, help='trainable weights written by util.save')
+    parser.add_argument('--scale', type=float, default=1.0, help='--scale the checkpoint was trained with')
+    parser.add_argument('--num_classes', type=int, default=None, help='only needed without --checkpoint')
+    parser.add_argument('--r', type=int, default=2, help='only needed without --checkpoint')
+    parser.add_argument('--img_size', type=int, default=224)
+    parser.add_argument('--format', default='torchscript', type=str, choices=FORMATS)
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--no_merge', default=False, action='store_true',
+                        help='export the training-graph model instead of the merged inference module')
+    parser.add_argument('--batch_size', type=int, default=2, help='batch size of the example input')
+    args = parser.parse_args()
+
+    module = build_model(args)
+    example = torch.randn(args.batch_size, 3, args.img_size, args.img_size)
+    start = time.time()
+    artifact = export(module, example, args.format, args.output, opset=args.opset)
+    write('wrote {} ({}) in {:.1f}s'.format(args.output, args.format, time.time() - start))
+
+    with torch.no_grad():
+        for batch_size in sorted({1, args.batch_size, 2 * args.batch_size}):
+            x = torch.randn(batch_size, 3, args.img_size, args.img_size)
+            err = (artifact(x) - module(x)).abs().max().item()
+            write('batch {}: max abs diff vs eager {:.2e}'.format(batch_size, err))
+            assert err < 1e-3
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+""" Inference-only export of WST VisionTransformer models
+
+merge_for_inference() rewrites a trained model into a forward-only module that drops the dead work of the
+training graph:
+  * the small-scale patch embedding and the first DWT are folded into a single strided conv,
+  * for orthogonal wavelets (haar) IDWT followed by the next block's DWT is the identity, so the small_x
+    stream is carried in token layout and no block runs a DWT/IDWT (this includes the unused IDWT of the
+    last block),
+  * adapter_down/adapter_up are folded into one dim x dim linear when that is cheaper than rank r,
+  * the frozen Block weights are shared with the source model, in eval mode and without grad.
+"""
+import torch
+import torch.nn as nn
+
+
+def fold_dwt_into_conv(conv, dwt):
+    """ Patch-embedding conv (kernel == stride) followed by one 2x2 DWT level -> one conv with 2x kernel/stride
+
+    Output channels follow the DWT layout, cat([ll, lh, hl, hh], dim=1).
+    """
+    C, in_chans, kh, kw = conv.weight.shape
+    assert conv.stride == (kh, kw), 'only non-overlapping patch embeddings can be folded'
+    filters = torch.cat(dwt.cast_filters(conv.weight.dtype, conv.weight.device), dim=0).squeeze(1)
+    assert filters.shape[-2:] == (2, 2), 'only 2x2 wavelet filters can be folded'
+    weight = torch.einsum('kij,cnuv->kcniujv', filters, conv.weight).reshape(4 * C, in_chans, 2 * kh, 2 * kw)
+    folded = nn.Conv2d(in_chans, 4 * C, kernel_size=(2 * kh, 2 * kw), stride=(2 * kh, 2 * kw))
+    folded.weight.data.copy_(weight)
+    if conv.bias is not None:
+        folded.bias.data.copy_((filters.sum(dim=(1, 2))[:, None] * conv.bias[None]).reshape(-1))
+    else:
+        folded.bias.data.zero_()
+    return folded
+
+
+def is_orthogonal(dwt, idwt, dim, grid_size=(4, 4)):
+    """ True when dwt(idwt(z)) == z, i.e. the small_x stream can skip both transforms between blocks
+    """
+    z = torch.randn(1, dim, *grid_size, device=idwt.filters.device)
+    return torch.allclose(dwt(idwt(z)), z, atol=1e-5)
+
+
+class MergedAdapter(nn.Module):
+    """ adapter_up(adapter_down(x)), folded into a single dim x dim linear if r > dim / 2
+    """
+    def __init__(self, adapter_down, adapter_up):
+        super().__init__()
+        r, dim = adapter_down.weight.shape
+        self.folded = 2 * r * dim > dim * dim
+        if self.folded:
+            self.proj = nn.Linear(dim, dim)
+            self.proj.weight.data.copy_(adapter_up.weight @ adapter_down.weight)
+            self.proj.bias.data.copy_(adapter_up.weight @ adapter_down.bias + adapter_up.bias)
+        else:
+            self.adapter_down = adapter_down
+            self.adapter_up = adapter_up
+
+    def forward(self, x):
+        if self.folded:
+            return self.proj(x)
+        return self.adapter_up(self.adapter_down(x))
+
+
+class InferenceBlock(nn.Module):
+    """ Block in eval-only form, small_x is the previous block's wave_x in token layout
+    """
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+        self.attn = block.attn
+        self.norm2 = block.norm2
+        self.mlp = block.mlp
+        self.adapter = MergedAdapter(block.waveblock.adapter_down, block.waveblock.adapter_up)
+        self.scale = block.scale
+
+    def forward(self, x, small_x):
+        wave_x = self.adapter(small_x + x[:, 1:, :])
+        x = x + self.attn(self.norm1(x))
+        x = x + self.mlp(self.norm2(x))
+        x = torch.cat((x[:, :1, :], x[:, 1:, :] + self.scale * wave_x), dim=1)
+        return x, wave_x
+
+
+class InferenceVisionTransformer(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        assert model.dist_token is None, 'distilled models are not supported'
+        first = model.blocks[0].waveblock
+        for block in model.blocks:
+            if not is_orthogonal(block.waveblock.dwt, block.waveblock.idwt, model.embed_dim):
+                raise ValueError('merge_for_inference needs an orthogonal wavelet (e.g. haar)')
+        self.num_classes = model.num_classes
+        self.small_patch_embed = fold_dwt_into_conv(model.small_patch_embed.proj, first.dwt)
+        self.patch_embed = model.patch_embed
+        self.cls_token = model.cls_token
+        self.pos_embed = model.pos_embed
+        self.blocks = nn.ModuleList([InferenceBlock(block) for block in model.blocks])
+        self.norm = model.norm
+        self.pre_logits = model.pre_logits
+        self.head = model.head
+
+    def forward(self, x):
+        small_x = self.small_patch_embed(x).flatten(2).transpose(1, 2)
+        x = self.patch_embed(x)
+        x = torch.cat((self.cls_token.expand(x.shape[0], -1, -1), x), dim=1) + self.pos_embed
+
+        for block in self.blocks:
+            x, small_x = block(x, small_x)
+
+        x = x[:, 1:].mean(dim=1)
+        x = self.pre_logits(self.norm(x))
+        return self.head(x)
+
+
+@torch.no_grad()
+def merge_for_inference(model):
+    """ Build the inference-only module for a trained WST VisionTransformer.
+
+    Frozen weights are shared with model (not copied), so model should not be trained afterwards.
+    """
+    model.eval()
+    merged = InferenceVisionTransformer(model)
+    merged.requires_grad_(False)
+    return merged.eval()
@@ -0,0 +1,144 @@
+""" Train K WST adapter configurations in one process on one shared frozen backbone
+
+Every configuration gets its own small patch embedding, WaveletBlocks (adapters with its own r), head,
+scale, drop path rate and optimizer hyperparameters. The frozen patch embedding + pos_embed prefix is
+computed once per batch and the K token streams are stacked along the batch dimension, so the frozen
+Blocks see one K*B batch instead of K processes each loading the backbone and decoding the same images.
+
+Sweep files are YAML lists of overrides of the command line defaults, e.g.
+
+    - {scale: 10, lr: 1.0e-3, r: 2}
+    - {scale: 1, lr: 5.0e-4, r: 4, drop_path: 0.1}
+"""
+import torch
+import torch.nn as nn
+import yaml
+from timm.models.layers import trunc_normal_
+
+from models.vision_transformer import SmallPatchEmbed, WaveletBlock
+
+SWEEP_KEYS = ('r', 'scale', 'lr', 'weight_decay', 'drop_path')
+
+
+def load_sweep(path, args):
+    """ Read a sweep file into a list of config dicts, missing keys fall back to args
+    """
+    with open(path, 'r') as f:
+        overrides = yaml.safe_load(f)
+    configs = []
+    for override in overrides:
+        unknown = set(override) - set(SWEEP_KEYS)
+        assert not unknown, 'unknown sweep keys {}, expected a subset of {}'.format(unknown, SWEEP_KEYS)
+        configs.append({k: override.get(k, getattr(args, k)) for k in SWEEP_KEYS})
+    return configs
+
+
+class ConfigAdapters(nn.Module):
+    """ Trainable part of one configuration: small patch embedding, one WaveletBlock per Block and the head
+    """
+    def __init__(self, model, config):
+        super().__init__()
+        proj = model.small_patch_embed.proj
+        self.small_patch_embed = SmallPatchEmbed(
+            img_size=model.patch_embed.img_size, small_patch_size=proj.kernel_size,
+            in_chans=proj.in_channels, small_embed_dim=proj.out_channels)
+        self.waveblocks = nn.ModuleList([
+            WaveletBlock(model.embed_dim, config['r'], grid_size=model.patch_embed.grid_size) for _ in model.blocks])
+        self.head = nn.Linear(model.num_features, model.num_classes)
+        trunc_normal_(self.head.weight, std=.02)
+        nn.init.constant_(self.head.bias, 0)
+        self.scale = config['scale']
+        depth = len(model.blocks)
+        self.drop_path = [x.item() for x in torch.linspace(0, config['drop_path'], depth)]
+
+
+class MultiConfigWST(nn.Module):
+    def __init__(self, model, configs):
+        super().__init__()
+        assert model.dist_token is None, 'distilled models are not supported'
+        # forward runs the attn / mlp branches of every Block itself, whole-block checkpointing cannot apply
+        assert not any(block.grad_checkpointing == 'blocks' for block in model.blocks), \
+            'MultiConfigWST supports grad checkpointing policies attn / mlp only, not blocks'
+        self.backbone = model
+        self.configs = configs
+        self.num_classes = model.num_classes
+        self.adapters = nn.ModuleList([ConfigAdapters(model, config) for config in configs])
+        # the backbone's own trainable parts are replaced by the per-config copies
+        model.small_patch_embed = None
+        model.head = nn.Identity()
+        for block in model.blocks:
+            block.waveblock = None
+        self.backbone.requires_grad_(False)
+
+    def param_groups(self):
+        """ Two AdamW groups (no decay on biases) per configuration with its own lr and weight decay
+        """
+        groups = []
+        for config, adapters in zip(self.configs, self.adapters):
+            decay, no_decay = [], []
+            for name, param in adapters.named_parameters():
+                (no_decay if name.endswith('.bias') else decay).append(param)
+            groups.append({'params': no_decay, 'weight_decay': 0., 'lr': config['lr']})
+            groups.append({'params': decay, 'weight_decay': config['weight_decay'], 'lr': config['lr']})
+        return groups
+
+    def trainable_state_dict(self, k):
+        """ State dict of configuration k, keyed like VisionTransformer (the format util.save writes)
+        """
+        state = {}
+        for name, param in self.adapters[k].named_parameters():
+            if name.startswith('waveblocks.'):
+                _, i, rest = name.split('.', 2)
+                name = 'blocks.{}.waveblock.{}'.format(i, rest)
+            state[name] = param.data
+        return state
+
+    def _drop_path(self, x, i):
+        if not self.training or not any(a.drop_path[i] > 0. for a in self.adapters):
+            return x
+        K = len(self.adapters)
+        keep = torch.tensor([1. - a.drop_path[i] for a in self.adapters], device=x.device, dtype=x.dtype)
+        keep = keep.view(K, 1, 1, 1)
+        xs = x.view(K, -1, *x.shape[1:])
+        mask = torch.rand(K, xs.shape[1], 1, 1, device=x.device, dtype=x.dtype) < keep
+        return (xs * mask / keep).view_as(x)
+
+    def forward(self, x):
+        """ Returns logits of shape (K, B, num_classes)
+        """
+        m = self.backbone
+        K, B = len(self.adapters), x.shape[0]
+        small_x = [a.small_patch_embed(x) for a in self.adapters]
+
+        x = m.patch_embed(x)
+        x = torch.cat((m.cls_token.expand(B, -1, -1), x), dim=1)
+        x = m.pos_drop(x + m.pos_embed)
+        x = x.repeat(K, 1, 1)
+        scale = x.new_tensor([a.scale for a in self.adapters]).view(K, 1, 1, 1)
+
+        for i, block in enumerate(m.blocks):
+            xs = x.view(K, B, *x.shape[1:])
+            outs = [a.waveblocks[i](xs[k], small_x[k]) for k, a in enumerate(self.adapters)]
+            wave_x = torch.stack([o[0] for o in outs])
+            small_x = [o[1] for o in outs]
+
+            # per-branch activation checkpointing of the Block applies here too, whole-block does not
+            x = x + self._drop_path(block._branch(block._attn, x, 'attn'), i)
+            x = x + self._drop_path(block._branch(block._mlp, x, 'mlp'), i)
+
+            xs = x.view(K, B, *x.shape[1:])
+            x = torch.cat((xs[:, :, :1], xs[:, :, 1:] + scale * wave_x), dim=2).view_as(x)
+
+        x = m.norm(x[:, 1:].mean(dim=1)).view(K, B, -1)
+        return torch.stack([a.head(x[k]) for k, a in enumerate(self.adapters)])
+
+
+class SweepLoss(nn.Module):
+    """ Sum over configurations of loss_fn(output[k], target), so each config gets the gradients of its own run
+    """
+    def __init__(self, loss_fn):
+        super().__init__()
+        self.loss_fn = loss_fn
+
+    def forward(self, output, target):
+        return sum(self.loss_fn(out, target) for out in output)
@@ -0,0 +1,175 @@
+""" Multi-task WST serving: one frozen ViT backbone shared by many adapter sets
+
+util.save() only writes the small_, adapter and head tensors of a fine-tuned model, so every VTAB task is a
+small delta on the same frozen backbone. MultiTaskWST loads the backbone once and registers those deltas by
+name. Batches may mix tasks: the backbone runs once over the whole batch and only the per-task parts
+(small patch embedding, adapters, head) are applied per task group. As in merge_for_inference, the haar
+IDWT -> DWT pairs between blocks are skipped and small_x is carried in token layout.
+
+    engine = MultiTaskWST(create_model('vit_base_patch16_224_in21k', checkpoint_path=npz, num_classes=0))
+    engine.register_task('dtd', 'checkpoint/.../best_save_model.pt', scale=10.)
+    engine.register_task('caltech101', 'checkpoint/.../best_save_model.pt', scale=10.)
+    outputs = engine.serve([('dtd', img0), ('caltech101', img1), ...])
+"""
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from models.inference import is_orthogonal, MergedAdapter
+
+
+def _tensor_bytes(tensors):
+    seen, total = set(), 0
+    for t in tensors:
+        if t.data_ptr() not in seen:
+            seen.add(t.data_ptr())
+            total += t.numel() * t.element_size()
+    return total
+
+
+class TaskAdapters(nn.Module):
+    """ The trainable part of one fine-tuned task, in inference form
+    """
+    def __init__(self, state_dict, depth, scale):
+        super().__init__()
+        # kept unfolded: folding the DWT in (as merge_for_inference does) would make it 16x larger per task
+        weight = state_dict['small_patch_embed.proj.weight']
+        self.small_patch_embed = nn.Conv2d(
+            weight.shape[1], weight.shape[0], kernel_size=weight.shape[-2:], stride=weight.shape[-2:])
+        self.small_patch_embed.weight.data.copy_(weight)
+        self.small_patch_embed.bias.data.copy_(state_dict['small_patch_embed.proj.bias'])
+
+        adapters = []
+        for i in range(depth):
+            prefix = 'blocks.{}.waveblock.'.format(i)
+            down_w, up_w = state_dict[prefix + 'adapter_down.weight'], state_dict[prefix + 'adapter_up.weight']
+            down, up = nn.Linear(down_w.shape[1], down_w.shape[0]), nn.Linear(up_w.shape[1], up_w.shape[0])
+            down.weight.data.copy_(down_w)
+            down.bias.data.copy_(state_dict[prefix + 'adapter_down.bias'])
+            up.weight.data.copy_(up_w)
+            up.bias.data.copy_(state_dict[prefix + 'adapter_up.bias'])
+            adapters.append(MergedAdapter(down, up))
+        self.adapters = nn.ModuleList(adapters)
+
+        head_w = state_dict['head.weight']
+        self.head = nn.Linear(head_w.shape[1], head_w.shape[0])
+        self.head.weight.data.copy_(head_w)
+        self.head.bias.data.copy_(state_dict['head.bias'])
+        self.scale = scale
+        self.num_classes = head_w.shape[0]
+
+
+class MultiTaskWST(nn.Module):
+    def __init__(self, backbone):
+        super().__init__()
+        assert backbone.dist_token is None, 'distilled models are not supported'
+        for block in backbone.blocks:
+            if not is_orthogonal(block.waveblock.dwt, block.waveblock.idwt, backbone.embed_dim):
+                raise ValueError('MultiTaskWST needs an orthogonal wavelet (e.g. haar)')
+        self.dwt = backbone.blocks[0].waveblock.dwt
+        self.patch_embed = backbone.patch_embed
+        self.cls_token = backbone.cls_token
+        self.pos_embed = backbone.pos_embed
+        self.blocks = nn.ModuleList([
+            nn.ModuleDict(OrderedDict(norm1=b.norm1, attn=b.attn, norm2=b.norm2, mlp=b.mlp)) for b in backbone.blocks])
+        self.norm = backbone.norm
+        self.pre_logits = backbone.pre_logits
+        self.tasks = nn.ModuleDict()
+        self.requires_grad_(False)
+        self.eval()
+
+    @torch.no_grad()
+    def register_task(self, name, checkpoint, scale):
+        """ checkpoint is a path written by util.save or the state dict itself, scale is the --scale it was trained with
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = torch.load(checkpoint, map_location='cpu')
+        task = TaskAdapters(checkpoint, len(self.blocks), scale)
+        task.to(self.pos_embed.device)
+        task.requires_grad_(False)
+        self.tasks[name] = task.eval()
+        return task
+
+    def unregister_task(self, name):
+        del self.tasks[name]
+
+    def _groups(self, tasks, device):
+        if isinstance(tasks, str):
+            return [(self.tasks[tasks], None)]
+        groups = OrderedDict()
+        for i, name in enumerate(tasks):
+            groups.setdefault(name, []).append(i)
+        if len(groups) == 1:
+            return [(self.tasks[tasks[0]], None)]
+        return [(self.tasks[name], torch.tensor(idx, device=device)) for name, idx in groups.items()]
+
+    @staticmethod
+    def _per_group(groups, fn, inp, out_shape):
+        if groups[0][1] is None:
+            return fn(groups[0][0], inp)
+        out = inp.new_empty(out_shape)
+        for task, idx in groups:
+            out[idx] = fn(task, inp[idx])
+        return out
+
+    @torch.no_grad()
+    def forward(self, x, tasks):
+        """ tasks is one task name for the whole batch or one name per sample.
+
+        Returns the logits tensor for a single task, otherwise a list with one logits row per sample.
+        """
+        B = x.shape[0]
+        groups = self._groups(tasks, x.device)
+
+        small_x = self._per_group(
+            groups, lambda t, inp: self.dwt(t.small_patch_embed(inp)), x,
+            (B, self.pos_embed.shape[-1], *self.patch_embed.grid_size)).flatten(2).transpose(1, 2)
+        x = self.patch_embed(x)
+        x = torch.cat((self.cls_token.expand(B, -1, -1), x), dim=1) + self.pos_embed
+
+        if groups[0][1] is None:
+            scale = groups[0][0].scale
+        else:
+            scale = x.new_empty(B, 1, 1)
+            for task, idx in groups:
+                scale[idx] = task.scale
+
+        for i, block in enumerate(self.blocks):
+            wave_x = self._per_group(groups, lambda t, inp: t.adapters[i](inp), small_x + x[:, 1:, :], small_x.shape)
+            x = x + block['attn'](block['norm1'](x))
+            x = x + block['mlp'](block['norm2'](x))
+            x = torch.cat((x[:, :1, :], x[:, 1:, :] + scale * wave_x), dim=1)
+            small_x = wave_x
+
+        x = self.pre_logits(self.norm(x[:, 1:].mean(dim=1)))
+        if groups[0][1] is None:
+            return groups[0][0].head(x)
+        outputs = [None] * B
+        for task, idx in groups:
+            for i, row in zip(idx.tolist(), task.head(x[idx])):
+                outputs[i] = row
+        return outputs
+
+    def serve(self, requests, max_batch_size=64):
+        """ requests: list of (task name, CHW image tensor). Returns one logits tensor per request, in order.
+
+        Requests are packed into mixed-task micro-batches of up to max_batch_size images.
+        """
+        outputs = []
+        for start in range(0, len(requests), max_batch_size):
+            chunk = requests[start:start + max_batch_size]
+            x = torch.stack([img for _, img in chunk]).to(self.pos_embed.device)
+            out = self(x, [name for name, _ in chunk])
+            outputs.extend(out if isinstance(out, list) else list(out))
+        return outputs
+
+    def memory_report(self):
+        """ Bytes held by the shared backbone and by each registered task
+        """
+        task_params = set(p.data_ptr() for p in self.tasks.parameters())
+        backbone = _tensor_bytes(t for t in list(self.parameters()) + list(self.buffers())
+                                 if t.data_ptr() not in task_params)
+        tasks = OrderedDict((name, _tensor_bytes(task.parameters())) for name, task in self.tasks.items())
+        return dict(backbone=backbone, tasks=tasks, total=backbone + sum(tasks.values()),
+                    separate_models=len(tasks) * backbone + sum(tasks.values()))
@@ -0,0 +1,262 @@
+""" Opt-in per-component profiling of WST models
+
+ModuleProfiler attaches forward and backward hooks to the components of a VisionTransformer (or of the
+MultiConfigWST around one) and accumulates, over all blocks, their wall time and forward FLOPs:
+  small_patch_embed, patch_embed, attn, mlp, waveblock (the whole WaveletBlock, which includes the
+  dwt / adapter / idwt rows below it), head.
+The fused haar WaveletBlock (the default) never calls its dwt / idwt modules: there the rows time the segments
+of forward_fused through WaveletBlock.segment_scope, dwt the sub-pixel regrouping and the linear with the DWT
+folded into adapter_down, adapter the adapter_down / adapter_up calls, idwt the linear with the IDWT folded into
+adapter_up. Those segments are plain ops, not modules, so their rows have forward time only ('-' for backward,
+which is part of the waveblock row). Times are inclusive host wall times (synchronized on CUDA); the patch
+embeddings take the pixels, which need no gradient, so they get no backward time. FLOPs are the forward FLOPs
+per image that torch.utils.flop_counter counts once at the first start(), times the images seen, plus
+2 * in * out per token for the dynamic int8 linears (models.quantization), whose quantized GEMM it does not
+know. The forwards that --grad_checkpointing reruns during backward are not counted as forward calls: their
+time is part of the backward time of the component whose backward triggers the recompute.
+
+It follows the train_one_epoch step-hook protocol: start() attaches the hooks (and, for the first epoch with
+trace_path, starts a torch.profiler chrome trace with a record_function scope per component), summary()
+detaches them again and returns the table. Nothing is attached while it is not started, so a model that is
+not being profiled runs exactly as before.
+"""
+import contextlib
+import time
+import warnings
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+COMPONENTS = ('small_patch_embed', 'patch_embed', 'attn', 'mlp', 'waveblock', 'dwt', 'adapter', 'idwt', 'head')
+NESTED = ('dwt', 'adapter', 'idwt')  # inside waveblock
+PIXEL_INPUT = ('small_patch_embed', 'patch_embed')
+
+
+def component_modules(model):
+    """ (qualified name, module, component) of every profiled submodule of model
+    """
+    from models.multiconfig import ConfigAdapters
+    from models.vision_transformer import Block, VisionTransformer, WaveletBlock
+
+    out = []
+    for name, m in model.named_modules():
+        prefix = name + '.' if name else ''
+        if isinstance(m, VisionTransformer):
+            out.append((prefix + 'patch_embed', m.patch_embed, 'patch_embed'))
+        if isinstance(m, (VisionTransformer, ConfigAdapters)):
+            # a MultiConfigWST backbone has neither, every ConfigAdapters has both
+            if m.small_patch_embed is not None:
+                out.append((prefix + 'small_patch_embed', m.small_patch_embed, 'small_patch_embed'))
+            if isinstance(m.head, nn.Linear):
+                out.append((prefix + 'head', m.head, 'head'))
+        elif isinstance(m, Block):
+            out += [(prefix + 'attn', m.attn, 'attn'), (prefix + 'mlp', m.mlp, 'mlp')]
+        elif isinstance(m, WaveletBlock):
+            out.append((name, m, 'waveblock'))
+            if not m.fused:  # fused: dwt / adapter / idwt are timed by segment_scope
+                out += [(prefix + 'dwt', m.dwt, 'dwt'), (prefix + 'idwt', m.idwt, 'idwt'),
+                        (prefix + 'adapter_down', m.adapter_down, 'adapter'),
+                        (prefix + 'adapter_up', m.adapter_up, 'adapter')]
+    return out
+
+
+def _recomputing():
+    """ Whether a forward runs inside backward, i.e. is activation checkpointing recomputing it
+    """
+    return torch._C._current_graph_task_id() != -1
+
+
+def fused_waveblocks(model):
+    from models.vision_transformer import WaveletBlock
+
+    return [m for m in model.modules() if isinstance(m, WaveletBlock) and m.fused]
+
+
+class ModuleProfiler:
+    def __init__(self, model, trace_path=None):
+        self.model = model
+        self.trace_path = trace_path
+        self.flops_per_image = None
+        self.epochs = 0
+        self._handles = []
+        self._trace = None
+        self._warnings = None
+        self._segments = []  # fused WaveletBlocks whose segment_scope is set
+        self._started = {}  # (module, 'fwd' / 'bwd') -> start time, record_function scope
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @torch.no_grad()
+    def _count_flops(self):
+        from torch.utils.flop_counter import FlopCounterMode
+        from models.quantization import Int8Linear
+        from models.vision_transformer import VisionTransformer
+
+        flops = OrderedDict((c, 0) for c in COMPONENTS)
+
+        @contextlib.contextmanager
+        def count_segment(component):
+            with FlopCounterMode(display=False) as counter:
+                yield
+            flops[component] += counter.get_total_flops()
+
+        int8_flops = {}  # name -> FLOPs of the dynamic int8 linears
+
+        def count_int8(name):
+            def hook(module, args, output):
+                int8_flops[name] = int8_flops.get(name, 0) + 2 * args[0].numel() * module.out_features
+            return hook
+
+        handles = [m.register_forward_hook(count_int8(name)) for name, m in self.model.named_modules()
+                   if isinstance(m, Int8Linear) and m.mode == 'dynamic']
+        for block in self._segments:
+            block.segment_scope = count_segment
+        vit = next(m for m in self.model.modules() if isinstance(m, VisionTransformer))
+        x = torch.zeros(1, 3, *vit.patch_embed.img_size, device=self.device)
+        try:
+            with torch.random.fork_rng(devices=[]), FlopCounterMode(display=False) as counter:
+                self.model(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+            for block in self._segments:
+                block.segment_scope = None
+        counts = {name: sum(ops.values()) for name, ops in counter.get_flop_counts().items()}
+        root = type(self.model).__name__
+        for name, _, component in self.modules:
+            flops[component] += counts.get('{}.{}'.format(root, name), 0)
+            flops[component] += sum(n for int8_name, n in int8_flops.items() if int8_name.startswith(name + '.'))
+        return flops
+
+    def _hooks(self, component):
+        def pre(module, *args):
+            if _recomputing():
+                return
+            self._synchronize()
+            scope = None
+            if self._trace is not None:
+                scope = torch.autograd.profiler.record_function('wst::' + component)
+                scope.__enter__()
+            self._started[module, 'fwd'] = time.perf_counter(), scope
+
+        def post(module, *args):
+            if _recomputing():
+                return
+            self._synchronize()
+            start, scope = self._started.pop((module, 'fwd'))
+            self.times[component][0] += time.perf_counter() - start
+            self.calls[component] += 1
+            if scope is not None:
+                scope.__exit__(None, None, None)
+
+        def backward_pre(module, grad_output):
+            self._synchronize()
+            self._started[module, 'bwd'] = time.perf_counter(), None
+
+        def backward(module, grad_input, grad_output):
+            self._synchronize()
+            self.times[component][1] += time.perf_counter() - self._started.pop((module, 'bwd'))[0]
+
+        return pre, post, backward_pre, backward
+
+    @contextlib.contextmanager
+    def _segment(self, component):
+        if _recomputing():
+            yield
+            return
+        self._synchronize()
+        scope = None
+        if self._trace is not None:
+            scope = torch.autograd.profiler.record_function('wst::' + component)
+            scope.__enter__()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self.times[component][0] += time.perf_counter() - start
+            self.calls[component] += 1
+            if scope is not None:
+                scope.__exit__(None, None, None)
+
+    def _count_images(self, module, args):
+        self.images += args[0].shape[0]
+
+    def start(self):
+        self.device = next(self.model.parameters()).device
+        self.modules = component_modules(self.model)
+        self._segments = fused_waveblocks(self.model)
+        if self.flops_per_image is None:
+            self.flops_per_image = self._count_flops()
+        self.times = OrderedDict((c, [0., 0.]) for c in COMPONENTS)
+        self.calls = OrderedDict((c, 0) for c in COMPONENTS)
+        self.images = 0
+        self.epochs += 1
+        if self.trace_path and self.epochs == 1:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(activities=activities)
+            self._trace.__enter__()
+        # the first attn takes tokens of the frozen patch embedding, its backward hook then fires on grad_output only;
+        # the filter is undone in stop()
+        self._warnings = warnings.catch_warnings()
+        self._warnings.__enter__()
+        warnings.filterwarnings('ignore', message='Full backward hook is firing when gradients are computed with '
+                                'respect to module outputs')
+        for block in self._segments:
+            block.segment_scope = self._segment
+        self._handles = [self.model.register_forward_pre_hook(self._count_images)]
+        for _, module, component in self.modules:
+            pre, post, backward_pre, backward = self._hooks(component)
+            self._handles += [module.register_forward_pre_hook(pre), module.register_forward_hook(post)]
+            if component not in PIXEL_INPUT:
+                self._handles += [module.register_full_backward_pre_hook(backward_pre),
+                                  module.register_full_backward_hook(backward)]
+        self._synchronize()
+        self.start_time = time.perf_counter()
+
+    def __call__(self, step):
+        pass
+
+    def stop(self):
+        self._synchronize()
+        self.wall_time = time.perf_counter() - self.start_time
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._started = {}
+        for block in self._segments:
+            block.segment_scope = None
+        if self._warnings is not None:
+            self._warnings.__exit__(None, None, None)
+            self._warnings = None
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace.export_chrome_trace(self.trace_path)
+            self._trace = None
+
+    def summary(self):
+        """ Stops profiling and returns the per-component table of this epoch
+        """
+        if self._handles:
+            self.stop()
+        lines = ['profile: {} images, {:.3f} s wall time{}'.format(
+            self.images, self.wall_time, ', chrome trace: {}'.format(self.trace_path)
+            if self.trace_path and self.epochs == 1 else ''),
+            '{:20s} {:>7s} {:>10s} {:>10s} {:>6s} {:>12s} {:>9s}'.format(
+            'component', 'calls', 'fwd s', 'bwd s', '%', 'fwd GFLOPs', 'GFLOP/s')]
+        forward_only = NESTED if self._segments else ()
+        for c in COMPONENTS:
+            if not self.calls[c]:
+                continue
+            fwd, bwd = self.times[c]
+            gflops = self.flops_per_image[c] * self.images / 1e9
+            lines.append('{:20s} {:7d} {:10.3f} {:>10s} {:6.1f} {:12.1f} {:9.1f}'.format(
+                ('  ' if c in NESTED else '') + c, self.calls[c], fwd,
+                '-' if c in forward_only else '{:.3f}'.format(bwd), 100 * (fwd + bwd) / self.wall_time,
+                gflops, gflops / fwd if fwd else 0.))
+        return '\n'.join(lines)
@@ -0,0 +1,102 @@
+""" Int8 weight quantization of the frozen ViT backbone
+
+quantize_backbone() replaces attn.qkv, attn.proj, mlp.fc1 and mlp.fc2 of every Block by an Int8Linear with
+symmetric per-output-channel int8 weights:
+  * dynamic: activations are quantized per call as well and the product runs in the int8 GEMM of the CPU
+    quantized engine (fbgemm / x86), CPU only,
+  * weight: weight-only, the int8 weights are dequantized for every call (memory saving only, any device).
+The WaveletBlock adapters, small_patch_embed, the norms and the head stay float, so the model still trains:
+gradients flow to the input straight-through, i.e. backward is the float linear with the dequantized weight,
+and the int8 weights themselves get none.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZE_MODES = ('none', 'dynamic', 'weight')
+QUANTIZED_LINEARS = ('attn.qkv', 'attn.proj', 'mlp.fc1', 'mlp.fc2')
+
+
+def quantize_weight(weight):
+    """ Symmetric per-output-channel int8: weight ~= weight_int8 * scale[:, None]
+    """
+    scale = weight.detach().abs().amax(dim=1).clamp(min=1e-12) / 127.
+    weight_int8 = torch.round(weight.detach() / scale[:, None]).clamp_(-127, 127).to(torch.int8)
+    return weight_int8, scale
+
+
+class _DynamicLinear(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, module):
+        ctx.module = module
+        return torch.ops.quantized.linear_dynamic(x.float(), module.packed, True).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # straight-through: the activation quantization counts as the identity
+        return grad_output @ ctx.module.dequantized_weight().to(grad_output.dtype), None
+
+
+class Int8Linear(nn.Module):
+    """ Frozen nn.Linear with int8 weights, see the module docstring for the modes
+    """
+    def __init__(self, linear, mode='dynamic'):
+        super().__init__()
+        assert mode in ('dynamic', 'weight'), 'mode should be dynamic or weight'
+        assert not linear.weight.requires_grad, 'only frozen linears are quantized'
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        self.mode = mode
+        self.has_bias = linear.bias is not None
+        weight_int8, scale = quantize_weight(linear.weight.float())
+        bias = linear.bias.detach().float() if linear.bias is not None else None
+        if mode == 'dynamic':
+            assert linear.weight.device.type == 'cpu', 'dynamic int8 linears run on CPU only'
+            qweight = torch._make_per_channel_quantized_tensor(
+                weight_int8, scale.double(), torch.zeros_like(scale, dtype=torch.long), 0)
+            # the packed (engine layout) weight is the only copy kept
+            self.packed = torch.ops.quantized.linear_prepack(qweight, bias)
+        else:
+            self.register_buffer('weight_int8', weight_int8)
+            self.register_buffer('weight_scale', scale)
+            self.register_buffer('bias', bias)
+
+    def dequantized_weight(self):
+        if self.mode == 'dynamic':
+            return torch.ops.quantized.linear_unpack(self.packed)[0].dequantize()
+        return self.weight_int8.float() * self.weight_scale[:, None]
+
+    def nbytes(self):
+        """ Bytes of the stored weight and bias, like weight.numel() * 4 for the fp32 linear
+        """
+        # int8 weight, fp32 scale and bias
+        return self.out_features * self.in_features + 4 * self.out_features * (1 + self.has_bias)
+
+    def forward(self, x):
+        if self.mode == 'dynamic':
+            return _DynamicLinear.apply(x, self)
+        weight = self.weight_int8.to(x.dtype) * self.weight_scale[:, None].to(x.dtype)
+        return F.linear(x, weight, self.bias.to(x.dtype) if self.bias is not None else None)
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, mode={}'.format(self.in_features, self.out_features, self.mode)
+
+
+def quantize_backbone(model, mode='dynamic'):
+    """ Replace the frozen qkv / proj / fc1 / fc2 linears of every Block in model by Int8Linear, in place.
+
+    Freeze the backbone (mark_trainable_parameters) first. Blocks shared with other modules
+    (MultiConfigWST, merge_for_inference) are quantized for all of them.
+    """
+    from models.vision_transformer import Block
+
+    if mode == 'none':
+        return model
+    assert mode in QUANTIZE_MODES, 'mode should be one of {}'.format(QUANTIZE_MODES)
+    for block in [m for m in model.modules() if isinstance(m, Block)]:
+        for name in QUANTIZED_LINEARS:
+            parent_name, attr = name.split('.')
+            parent = getattr(block, parent_name)
+            linear = getattr(parent, attr)
+            if isinstance(linear, nn.Linear):
+                setattr(parent, attr, Int8Linear(linear, mode))
+    return model
@@ -3,6 +3,11 @@
 
 import math
 import logging
+import inspect
+import os
+import json
+import hashlib
+from contextlib import nullcontext
 from functools import partial
 from collections import OrderedDict
 from copy import deepcopy
@@ -10,51 +15,100 @@ from copy import deepcopy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import wave
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD, IMAGENET_INCEPTION_MEAN, IMAGENET_INCEPTION_STD
 from timm.models.helpers import build_model_with_cfg, named_apply, adapt_input_conv
-from timm.models.layers import PatchEmbed, Mlp, DropPath, trunc_normal_, lecun_normal_
+from timm.models.layers import PatchEmbed, Mlp, DropPath, trunc_normal_, lecun_normal_, to_2tuple
 from timm.models.registry import register_model
 
 _logger = logging.getLogger(__name__)
 
 
+def _no_scope(name):
+    return nullcontext()
+
+
 class WaveletBlock(nn.Module):
     def __init__(
             self,
-            dim, r
+            dim, r, grid_size=(14, 14)
     ):
         super(WaveletBlock, self).__init__()
 
         self.r = r
+        # patch token grid, the small-scale branch runs on a 2x finer grid with dim // 4 channels
+        self.grid_size = tuple(grid_size)
         self.adapter_down = nn.Linear(dim, r)
         self.adapter_up = nn.Linear(r, dim)
+        self.reset_parameters()
 
+        self.dwt = wave.DWT_2D(wave='haar')
+        self.idwt = wave.IDWT_2D(wave='haar')
+        # haar: DWT and IDWT act on non-overlapping 2x2 sub-pixel groups, fold them into the adapters and stay
+        # in token layout (see forward_fused)
+        self.fused = self.dwt.fast and self.idwt.fast
+        # name -> context manager around that segment of forward_fused ('dwt', 'adapter', 'idwt'), set by
+        # models.profiling.ModuleProfiler while it profiles
+        self.segment_scope = None
+
+    def reset_parameters(self):
         trunc_normal_(self.adapter_down.weight, std=.02)
         nn.init.zeros_(self.adapter_down.bias)
 
         trunc_normal_(self.adapter_up.weight, std=.02)
         nn.init.zeros_(self.adapter_up.bias)
 
-        self.dwt = wave.DWT_2D(wave='haar')
-        self.idwt = wave.IDWT_2D(wave='haar')
+    def forward_fused(self, x, small_x):
+        """ forward() for 2x2 filter banks without the NCHW round trips.
+
+        With g the 2x2 sub-pixel groups of small_x and M the 4x4 filter matrix (rows: subbands, columns:
+        sub-pixels), dwt(small_x) = M g per channel, so adapter_down(dwt(small_x)) is a linear of g with the
+        filters folded into the weight. Likewise idwt(adapter_up(z)) = M^T adapter_up(z) is adapter_up with
+        folded weight and bias, written straight back into the sub-pixel order of the fine grid.
+        """
+        B, N, C = x.shape
+        H, W = self.grid_size
+        c, r = C // 4, self.adapter_down.out_features
+        weight = self.adapter_down.weight
+        scope = self.segment_scope or _no_scope
+
+        with scope('dwt'):
+            m_dwt = torch.cat(self.dwt.cast_filters(weight.dtype, weight.device)).reshape(4, 4)
+            # (B, 4HW, c) fine grid -> (B, HW, 4c), the 4 sub-pixels of each coarse token side by side
+            groups = small_x.reshape(B, H, 2, W, 2, c).permute(0, 1, 3, 2, 4, 5).reshape(B, H * W, C)
+            w_down = torch.einsum('rkc,kp->rpc', weight.reshape(r, 4, c), m_dwt).reshape(r, C)
+            z = F.linear(groups, w_down)
+        with scope('adapter'):
+            z = z + self.adapter_down(x)[:, 1:, :]
+            wave_x = self.adapter_up(z)
+        with scope('idwt'):
+            m_idwt = self.idwt.cast_filters(weight.dtype, weight.device)[0].reshape(4, 4)
+            w_up = torch.einsum('kp,kcr->pcr', m_idwt, self.adapter_up.weight.reshape(4, c, r)).reshape(C, r)
+            b_up = torch.einsum('kp,kc->pc', m_idwt, self.adapter_up.bias.reshape(4, c)).reshape(C)
+            small_x = F.linear(z, w_up, b_up)
+            small_x = small_x.reshape(B, H, W, 2, 2, c).permute(0, 1, 3, 2, 4, 5).reshape(B, 4 * H * W, c)
+        return wave_x, small_x
 
     def forward(self, x, small_x):
+        if self.fused:
+            return self.forward_fused(x, small_x)
         B, N, C = x.shape
-        small_x = small_x.reshape(B, 28, 28, 192).permute(0, 3, 1, 2)
+        H, W = self.grid_size
+        small_x = small_x.reshape(B, 2 * H, 2 * W, C // 4).permute(0, 3, 1, 2)
 
         small_x = self.dwt(small_x)
-        small_x = small_x.reshape(B, 768, -1).permute(0, 2, 1)
+        small_x = small_x.reshape(B, C, -1).permute(0, 2, 1)
 
         small_x = small_x + x[:, 1:, :]
 
         wave_x = self.adapter_down(small_x)
         wave_x = self.adapter_up(wave_x)
 
-        small_x = wave_x.reshape(B, 14, 14, 768).permute(0, 3, 1, 2)
+        small_x = wave_x.reshape(B, H, W, C).permute(0, 3, 1, 2)
         small_x = self.idwt(small_x)
 
-        small_x = small_x.reshape(B, 192, -1).permute(0, 2, 1)
+        small_x = small_x.reshape(B, C // 4, -1).permute(0, 2, 1)
 
         return wave_x, small_x
 
@@ -220,13 +274,27 @@ default_cfgs = {
 }
 
 
+ATTN_BACKENDS = ('eager', 'sdpa', 'chunked')
+# what set_grad_checkpointing recomputes in backward: nothing, every k-th block, the attention or the MLP branches
+CHECKPOINT_POLICIES = ('none', 'blocks', 'attn', 'mlp')
+
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., attn_backend='eager',
+                 chunk_size=64):
         super().__init__()
         assert dim % num_heads == 0, 'dim should be divisible by num_heads'
+        assert attn_backend in ATTN_BACKENDS, 'attn_backend should be one of {}'.format(ATTN_BACKENDS)
+        if attn_backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            _logger.warning('scaled_dot_product_attention needs torch >= 2.0, falling back to chunked attention')
+            attn_backend = 'chunked'
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim ** -0.5
+        # eager: full attention matrix, sdpa: fused torch kernel (flash / memory-efficient / math),
+        # chunked: eager attention over chunk_size queries at a time to bound the attention matrix size
+        self.attn_backend = attn_backend
+        self.chunk_size = chunk_size
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
 
@@ -234,44 +302,75 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+    def _attend(self, q, k, v):
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+        return attn @ v
+
     def forward(self, x):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.attn_backend == 'sdpa':
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.)
+        elif self.attn_backend == 'chunked':
+            x = torch.cat([self._attend(q_chunk, k, v) for q_chunk in q.split(self.chunk_size, dim=2)], dim=2)
+        else:
+            x = self._attend(q, k, v)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
 class Block(nn.Module):
 
-    def __init__(self, dim, r, scale, num_heads, mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0., drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+    def __init__(self, dim, r, scale, num_heads, mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0., drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, grid_size=(14, 14), attn_backend='eager'):
         super().__init__()
         self.norm1 = norm_layer(dim)
-        self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop)
+        self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop,
+                              attn_backend=attn_backend)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
-        self.waveblock = WaveletBlock(dim, r)
+        self.waveblock = WaveletBlock(dim, r, grid_size=grid_size)
         self.scale = scale
-    def forward(self, x, small_x):
+        # activation checkpointing (CHECKPOINT_POLICIES): None, 'blocks' (this whole block), 'attn' or 'mlp' (that
+        # branch only), see VisionTransformer.set_grad_checkpointing
+        self.grad_checkpointing = None
+
+    def _attn(self, x):
+        return self.attn(self.norm1(x))
+
+    def _mlp(self, x):
+        return self.mlp(self.norm2(x))
+
+    def _branch(self, fn, x, name):
+        if self.grad_checkpointing == name and torch.is_grad_enabled():
+            return checkpoint(fn, x, use_reentrant=False)
+        return fn(x)
+
+    def _forward(self, x, small_x):
         B,N,C = x.shape
         wave_x, small_x = self.waveblock(x, small_x)
 
-        x = x + self.drop_path(self.attn(self.norm1(x)))
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        x = x + self.drop_path(self._branch(self._attn, x, 'attn'))
+        x = x + self.drop_path(self._branch(self._mlp, x, 'mlp'))
 
-        x[:, 1:, :] = x[:, 1:, :] + self.scale * wave_x
+        # out of place: the cls token passes through, the patch tokens get the wavelet branch
+        x = torch.cat((x[:, :1, :], torch.add(x[:, 1:, :], wave_x, alpha=self.scale)), dim=1)
 
         return x, small_x
 
+    def forward(self, x, small_x):
+        if self.grad_checkpointing == 'blocks' and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, small_x, use_reentrant=False)
+        return self._forward(x, small_x)
+
 
 
 class SmallPatchEmbed(nn.Module):
@@ -279,8 +378,9 @@ class SmallPatchEmbed(nn.Module):
     """
     def __init__(self, img_size=224, small_patch_size=8, in_chans=3, small_embed_dim=192):
         super().__init__()
-        img_size = (img_size,img_size)
-        small_patch_size = (small_patch_size, small_patch_size)
+        img_size = to_2tuple(img_size)
+        small_patch_size = to_2tuple(small_patch_size)
+        self.grid_size = (img_size[0] // small_patch_size[0], img_size[1] // small_patch_size[1])
 
         self.proj = nn.Conv2d(in_chans, small_embed_dim, kernel_size=small_patch_size, stride=small_patch_size)
 
@@ -302,10 +402,10 @@ class VisionTransformer(nn.Module):
 
     """
 
-    def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, small_patch_size=8, small_embed_dim=192, depth=12,
+    def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, small_patch_size=None, small_embed_dim=None, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, representation_size=None, distilled=False,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., embed_layer=PatchEmbed, norm_layer=None,
-                 act_layer=None, weight_init='', r=2, scale=1.0, log_file=None):
+                 act_layer=None, weight_init='', r=2, scale=1.0, attn_backend='eager', weight_cache_dir=None, log_file=None):
         """
         Args:
             img_size (int, tuple): input image size
@@ -313,8 +413,8 @@ class VisionTransformer(nn.Module):
             in_chans (int): number of input channels
             num_classes (int): number of classes for classification head
             embed_dim (int): embedding dimension
-            small_patch_size (int, tuple): small patch size
-            small embed_dim (int): small embedding dimension
+            small_patch_size (int, tuple): small patch size, defaults to patch_size // 2
+            small embed_dim (int): small embedding dimension, defaults to embed_dim // 4
             depth (int): depth of transformer
             num_heads (int): number of attention heads
             mlp_ratio (int): ratio of mlp hidden dim to embedding dim
@@ -329,9 +429,12 @@ class VisionTransformer(nn.Module):
             weight_init: (str): weight init scheme
             r (int): middle dim
             scale (float): scaling factor
+            attn_backend (str): attention implementation, one of 'eager', 'sdpa', 'chunked'
+            weight_cache_dir (str): where load_pretrained caches .npz weights converted to torch, None to disable
         """
         super().__init__()
         self.num_classes = num_classes
+        self.weight_cache_dir = weight_cache_dir
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
         self.num_tokens = 2 if distilled else 1
         norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
@@ -340,9 +443,16 @@ class VisionTransformer(nn.Module):
         self.patch_embed = embed_layer(
             img_size=img_size, patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim)
 
+        small_patch_size = small_patch_size or tuple(p // 2 for p in self.patch_embed.patch_size)
+        small_embed_dim = small_embed_dim or embed_dim // 4
         self.small_patch_embed = SmallPatchEmbed(
             img_size=img_size, small_patch_size=small_patch_size, in_chans=in_chans, small_embed_dim=small_embed_dim)
         num_patches = self.patch_embed.num_patches
+        grid_size = self.patch_embed.grid_size
+        # one DWT level has to map the small-scale tokens onto the patch tokens
+        assert self.small_patch_embed.grid_size == (2 * grid_size[0], 2 * grid_size[1]), \
+            'small patch grid must be twice the patch grid'
+        assert 4 * small_embed_dim == embed_dim, 'small_embed_dim must be embed_dim // 4'
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.dist_token = nn.Parameter(torch.zeros(1, 1, embed_dim)) if distilled else None
@@ -353,11 +463,12 @@ class VisionTransformer(nn.Module):
         self.attn_drop_rate = attn_drop_rate
         self.r = r
         self.scale = scale
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
+        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth, device='cpu')]  # stochastic depth decay rule
         self.blocks = nn.Sequential(*[
             Block(
                 dim=embed_dim, r=r, scale=scale, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, drop=drop_rate,
-                attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, act_layer=act_layer)
+                attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, act_layer=act_layer,
+                grid_size=grid_size, attn_backend=attn_backend)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -373,8 +484,9 @@ class VisionTransformer(nn.Module):
 
         # Classifier head(s)
         self.head = nn.Linear(self.num_features, num_classes) if num_classes > 0 else nn.Identity()
-        trunc_normal_(self.head.weight, std=.02)
-        nn.init.constant_(self.head.bias, 0)
+        if num_classes > 0:
+            trunc_normal_(self.head.weight, std=.02)
+            nn.init.constant_(self.head.bias, 0)
         self.head_dist = None
         if distilled:
             self.head_dist = nn.Linear(self.embed_dim, self.num_classes) if num_classes > 0 else nn.Identity()
@@ -399,7 +511,77 @@ class VisionTransformer(nn.Module):
 
     @torch.jit.ignore()
     def load_pretrained(self, checkpoint_path, prefix=''):
-        _load_weights(self, checkpoint_path, prefix)
+        if self.pos_embed.is_meta:
+            # built on the meta device: the checkpoint tensors become the parameters, only the new ones are initialized
+            if self.weight_cache_dir:
+                state = cached_npz_state_dict(checkpoint_path, self.weight_cache_dir)
+            else:
+                state = _npz_state_dict(checkpoint_path)
+            _load_state_dict(self, state, assign=True)
+            self._init_new_parameters()
+        elif self.weight_cache_dir and not prefix and not hasattr(self.patch_embed, 'backbone'):
+            # the memory-mapped tensors replace the randomly initialized ones instead of being copied into them:
+            # copying faults the whole file in next to the model
+            assign = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters  # torch >= 2.1
+            _load_state_dict(self, cached_npz_state_dict(checkpoint_path, self.weight_cache_dir), assign=assign)
+        else:
+            _load_weights(self, checkpoint_path, prefix)
+
+    @torch.no_grad()
+    def _init_new_parameters(self, device='cpu'):
+        """ Allocate and initialize the tensors a meta-device model did not get from the checkpoint:
+        small_patch_embed, the adapters and the head, as __init__ would have.
+        """
+        if self.small_patch_embed.proj.weight.is_meta:
+            self.small_patch_embed.to_empty(device=device)
+            self.small_patch_embed.proj.reset_parameters()
+        for block in self.blocks:
+            if block.waveblock.adapter_down.weight.is_meta or block.waveblock.adapter_up.weight.is_meta:
+                block.waveblock.adapter_down.to_empty(device=device)
+                block.waveblock.adapter_up.to_empty(device=device)
+                block.waveblock.reset_parameters()
+        if isinstance(self.head, nn.Linear) and self.head.weight.is_meta:
+            self.head.to_empty(device=device)
+            trunc_normal_(self.head.weight, std=.02)
+            nn.init.constant_(self.head.bias, 0)
+        left = [n for n, t in list(self.named_parameters()) + list(self.named_buffers()) if t.is_meta]
+        assert not left, 'not in the checkpoint and not initialized: {}'.format(left)
+
+    @torch.jit.ignore
+    def set_input_size(self, img_size):
+        """ Switch the model to a new input resolution, resizing pos_embed with resize_pos_embed
+        """
+        img_size = to_2tuple(img_size)
+        patch_size = self.patch_embed.patch_size
+        small_patch_size = self.small_patch_embed.proj.kernel_size
+        grid_size = (img_size[0] // patch_size[0], img_size[1] // patch_size[1])
+        if grid_size != self.patch_embed.grid_size:
+            posemb_new = self.pos_embed.new_zeros(1, grid_size[0] * grid_size[1] + self.num_tokens, self.embed_dim)
+            posemb = resize_pos_embed(self.pos_embed.data, posemb_new, self.num_tokens, grid_size)
+            self.pos_embed = nn.Parameter(posemb, requires_grad=self.pos_embed.requires_grad)
+        self.patch_embed.img_size = img_size
+        self.patch_embed.grid_size = grid_size
+        self.patch_embed.num_patches = grid_size[0] * grid_size[1]
+        self.small_patch_embed.grid_size = (img_size[0] // small_patch_size[0], img_size[1] // small_patch_size[1])
+        assert self.small_patch_embed.grid_size == (2 * grid_size[0], 2 * grid_size[1]), \
+            'small patch grid must be twice the patch grid'
+        for block in self.blocks:
+            block.waveblock.grid_size = grid_size
+
+    @torch.jit.ignore
+    def set_grad_checkpointing(self, policy='blocks', every=1):
+        """ Recompute activations in backward instead of storing them.
+
+        policy 'blocks' checkpoints whole Blocks (every k-th one), 'attn' / 'mlp' only that branch of every Block.
+        The backbone is frozen, so this only trades recompute for the activations kept for the adapter gradients.
+        """
+        assert policy in CHECKPOINT_POLICIES, 'policy should be one of {}'.format(CHECKPOINT_POLICIES)
+        assert every >= 1, 'every should be >= 1, got {}'.format(every)
+        for i, block in enumerate(self.blocks):
+            if policy == 'blocks':
+                block.grad_checkpointing = 'blocks' if i % every == 0 else None
+            else:
+                block.grad_checkpointing = None if policy == 'none' else policy
 
     @torch.jit.ignore
     def no_weight_decay(self):
@@ -414,8 +596,9 @@ class VisionTransformer(nn.Module):
     def reset_classifier(self, num_classes, global_pool=''):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
-        trunc_normal_(self.head.weight, std=.02)
-        nn.init.constant_(self.head.bias, 0)
+        if num_classes > 0:
+            trunc_normal_(self.head.weight, std=.02)
+            nn.init.constant_(self.head.bias, 0)
         if self.num_tokens == 2:
             self.head_dist = nn.Linear(self.embed_dim, self.num_classes) if num_classes > 0 else nn.Identity()
 
@@ -559,6 +742,144 @@ def _load_weights(model: VisionTransformer, checkpoint_path: str, prefix: str =
         block.norm2.bias.copy_(_n2p(w[f'{block_prefix}LayerNorm_2/bias']))
 
 
+def _npz_state_dict(checkpoint_path):
+    """ Flax .npz -> state dict with VisionTransformer names, kernels transposed to torch layout and contiguous
+    """
+    import numpy as np
+
+    def _n2p(w, t=True):
+        if w.ndim == 4 and w.shape[0] == w.shape[1] == w.shape[2] == 1:
+            w = w.flatten()
+        if t:
+            if w.ndim == 4:
+                w = w.transpose([3, 2, 0, 1])
+            elif w.ndim == 3:
+                w = w.transpose([2, 0, 1])
+            elif w.ndim == 2:
+                w = w.transpose([1, 0])
+        return torch.from_numpy(w)
+
+    w = np.load(checkpoint_path)
+    prefix = 'opt/target/' if 'opt/target/embedding/kernel' in w else ''
+    assert f'{prefix}conv_root/kernel' not in w, 'hybrid checkpoints are not supported'
+    state = OrderedDict()
+    state['patch_embed.proj.weight'] = _n2p(w[f'{prefix}embedding/kernel'])
+    state['patch_embed.proj.bias'] = _n2p(w[f'{prefix}embedding/bias'])
+    state['cls_token'] = _n2p(w[f'{prefix}cls'], t=False)
+    state['pos_embed'] = _n2p(w[f'{prefix}Transformer/posembed_input/pos_embedding'], t=False)
+    state['norm.weight'] = _n2p(w[f'{prefix}Transformer/encoder_norm/scale'])
+    state['norm.bias'] = _n2p(w[f'{prefix}Transformer/encoder_norm/bias'])
+    if f'{prefix}head/bias' in w:
+        state['head.weight'] = _n2p(w[f'{prefix}head/kernel'])
+        state['head.bias'] = _n2p(w[f'{prefix}head/bias'])
+    if f'{prefix}pre_logits/bias' in w:
+        state['pre_logits.fc.weight'] = _n2p(w[f'{prefix}pre_logits/kernel'])
+        state['pre_logits.fc.bias'] = _n2p(w[f'{prefix}pre_logits/bias'])
+    i = 0
+    while f'{prefix}Transformer/encoderblock_{i}/LayerNorm_0/scale' in w:
+        block_prefix = f'{prefix}Transformer/encoderblock_{i}/'
+        mha_prefix = block_prefix + 'MultiHeadDotProductAttention_1/'
+        name = f'blocks.{i}.'
+        state[name + 'norm1.weight'] = _n2p(w[f'{block_prefix}LayerNorm_0/scale'])
+        state[name + 'norm1.bias'] = _n2p(w[f'{block_prefix}LayerNorm_0/bias'])
+        state[name + 'attn.qkv.weight'] = torch.cat([
+            _n2p(w[f'{mha_prefix}{n}/kernel'], t=False).flatten(1).T for n in ('query', 'key', 'value')])
+        state[name + 'attn.qkv.bias'] = torch.cat([
+            _n2p(w[f'{mha_prefix}{n}/bias'], t=False).reshape(-1) for n in ('query', 'key', 'value')])
+        state[name + 'attn.proj.weight'] = _n2p(w[f'{mha_prefix}out/kernel']).flatten(1)
+        state[name + 'attn.proj.bias'] = _n2p(w[f'{mha_prefix}out/bias'])
+        for r in range(2):
+            state[name + f'mlp.fc{r + 1}.weight'] = _n2p(w[f'{block_prefix}MlpBlock_3/Dense_{r}/kernel'])
+            state[name + f'mlp.fc{r + 1}.bias'] = _n2p(w[f'{block_prefix}MlpBlock_3/Dense_{r}/bias'])
+        state[name + 'norm2.weight'] = _n2p(w[f'{block_prefix}LayerNorm_2/scale'])
+        state[name + 'norm2.bias'] = _n2p(w[f'{block_prefix}LayerNorm_2/bias'])
+        i += 1
+    return OrderedDict((k, v.contiguous()) for k, v in state.items())
+
+
+def _file_sha1(path, cache_dir):
+    """ sha1 of the file contents, remembered in cache_dir per (path, size, mtime) so it is only computed once
+    """
+    index_path = os.path.join(cache_dir, 'sha1_index.json')
+    st = os.stat(path)
+    entry_key = '{}:{}:{}'.format(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    index = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except ValueError:
+            index = {}  # partially written by a concurrent run
+    if entry_key not in index:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 23), b''):
+                sha1.update(chunk)
+        index[entry_key] = sha1.hexdigest()
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return index[entry_key]
+
+
+def cached_npz_state_dict(checkpoint_path, cache_dir):
+    """ _npz_state_dict(checkpoint_path), converted on first use and saved in cache_dir keyed by the file hash.
+
+    Later calls memory-map the saved tensors (torch.load(mmap=True)), so nothing goes through numpy.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(checkpoint_path))[0]
+    path = os.path.join(cache_dir, '{}_{}.pt'.format(stem, _file_sha1(checkpoint_path, cache_dir)[:16]))
+    if not os.path.exists(path):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save(_npz_state_dict(checkpoint_path), tmp_path)
+        os.replace(tmp_path, path)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location='cpu')  # torch < 2.1 has no mmap
+
+
+@torch.no_grad()
+def _load_state_dict(model, state, assign=False):
+    """ Load a state dict from _npz_state_dict into model, with the adjustments _load_weights makes
+    """
+    state = OrderedDict(state)
+    in_chans = model.patch_embed.proj.weight.shape[1]
+    if state['patch_embed.proj.weight'].shape[1] != in_chans:
+        state['patch_embed.proj.weight'] = adapt_input_conv(in_chans, state['patch_embed.proj.weight'])
+    if state['pos_embed'].shape != model.pos_embed.shape:
+        state['pos_embed'] = resize_pos_embed(
+            state['pos_embed'], model.pos_embed, getattr(model, 'num_tokens', 1), model.patch_embed.grid_size)
+    if 'head.bias' in state and not (
+            isinstance(model.head, nn.Linear) and model.head.bias.shape == state['head.bias'].shape):
+        del state['head.weight'], state['head.bias']
+    if 'pre_logits.fc.bias' in state and not isinstance(getattr(model.pre_logits, 'fc', None), nn.Linear):
+        del state['pre_logits.fc.weight'], state['pre_logits.fc.bias']
+    _, unexpected = model.load_state_dict(state, strict=False, assign=assign) if assign else \
+        model.load_state_dict(state, strict=False)
+    assert not unexpected, 'unexpected keys {}'.format(unexpected)
+
+
+def create_pretrained(model_name, checkpoint_path, **kwargs):
+    """ create_model(model_name, checkpoint_path=checkpoint_path, **kwargs) for .npz checkpoints, without the
+    random init of the backbone: the model is built on the meta device and the backbone parameters are the
+    checkpoint tensors. Only small_patch_embed, the adapters and the head are allocated and initialized.
+
+    The backbone init no longer draws from the RNG first, so under the same seed these new tensors get other
+    initial values than with create_model: same checkpoint weights, but not the same seeded run.
+    """
+    from timm.models import create_model
+
+    if 'assign' not in inspect.signature(nn.Module.load_state_dict).parameters:
+        return create_model(model_name, checkpoint_path=checkpoint_path, **kwargs)  # torch < 2.1
+    with torch.device('meta'):
+        model = create_model(model_name, **kwargs)
+    model.load_pretrained(checkpoint_path)
+    return model
+
+
 def resize_pos_embed(posemb, posemb_new, num_tokens=1, gs_new=()):
     
     _logger.info('Resized position embedding: %s to %s', posemb.shape, posemb_new.shape)
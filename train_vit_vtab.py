@@ -11,19 +11,23 @@ import cv2
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.cuda.amp import autocast as amp_autocast
+from torch.nn.parallel import DistributedDataParallel as DDP
+from functools import partial
 from timm.scheduler.scheduler_factory import CosineLRScheduler
 from timm.data import resolve_data_config
 from contextlib import suppress
 
 from timm.models import create_model, safe_model_name
-from timm.utils import random_seed, AverageMeter, accuracy, NativeScaler, ModelEmaV2
+from timm.utils import random_seed, NativeScaler, ModelEmaV2
 from timm.data import Mixup, FastCollateMixup
 from timm.loss import SoftTargetCrossEntropy
-from utils.utils import write, create_transform, create_loader
+from utils.utils import write, create_transform, create_loader, DeviceMeter, StepTimer, top1_correct
 
-from data.vtab import VTAB
+from data.vtab import VTAB, VTABShard
 from models import vision_transformer
+from models.profiling import ModuleProfiler
+from models.quantization import QUANTIZE_MODES, quantize_backbone
+from models.multiconfig import MultiConfigWST, SweepLoss, load_sweep
 import utils.utils as util
 
 torch.backends.cudnn.benchmark = False
@@ -36,24 +40,63 @@ def mark_trainable_parameters(model: nn.Module, model_type):
         else:
             p.requires_grad = False
 
-    if model_type == 'vit_base_patch16_224_in21k':
+    if isinstance(model, MultiConfigWST):
+        for adapters in model.adapters:
+            adapters.head.requires_grad_(True)
+    elif model_type == 'vit_base_patch16_224_in21k':
         model.head.weight.requires_grad = True
         model.head.bias.requires_grad = True
     else:
         raise NotImplementedError
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('should be >= 1, got {}'.format(value))
+    return value
+
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--data_dir', default=None, type=str, help='data dir')
 parser.add_argument('--load_path', default=None, type=str, help='path for loading pretrained checkpoint')
+parser.add_argument('--meta_init', default=False, action='store_true',
+                    help='build the model on the meta device and only initialize the new adapter, small patch embedding '
+                         'and head tensors before loading the .npz --load_path (faster startup, but the same --seed '
+                         'gives them different initial values than the default full random init)')
+parser.add_argument('--weight_cache_dir', default=None, type=str,
+                    help='convert the .npz checkpoint to torch once and memory-map it in later runs, cached in this '
+                         'directory (e.g. weight_cache; about the size of the checkpoint)')
 
 parser.add_argument('--dataset', default='cifar_100', type=str,
                     choices=['cifar_100', 'dtd', 'patch_camelyon', 'eurosat', 'kitti', 'dmlab', 'caltech101',
                              'clevr_count', 'clevr_dist', 'diabetic_retinopathy', 'dsprites_loc', 'dsprites_ori',
                              'pets', 'flowers102', 'resisc45', 'smallnorb_azi', 'smallnorb_ele', 'sun397', 'svhn'])
 parser.add_argument('--model', default='vit_base_patch16_224_in21k', type=str)
+parser.add_argument('--img_size', type=int, default=224, help='input resolution, pos_embed is resized to match')
+parser.add_argument('--attn_backend', default='eager', type=str, choices=vision_transformer.ATTN_BACKENDS,
+                    help='attention implementation: eager, sdpa (fused kernel) or chunked')
+parser.add_argument('--grad_checkpointing', default='none', type=str, choices=vision_transformer.CHECKPOINT_POLICIES,
+                    help='recompute activations in backward: every k-th block (blocks), attention or MLP branches')
+parser.add_argument('--grad_checkpointing_every', type=positive_int, default=1, help='k for --grad_checkpointing blocks')
+parser.add_argument('--quantize', default='none', type=str, choices=QUANTIZE_MODES,
+                    help='int8 weights for the frozen qkv/proj/fc1/fc2 linears: dynamic (int8 GEMM, CPU only) or '
+                         'weight (weight-only, dequantized per call)')
 parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--eval_interval', type=int, default=1, help='evaluate every n epochs (always after the last one)')
+parser.add_argument('--eval_subset', type=int, default=0,
+                    help='evaluate on a fixed random subset of this many test images during training, with a full '
+                         'test pass only on a new best and at the end (default: 0, always the full test split)')
+parser.add_argument('--patience', type=int, default=0,
+                    help='stop after this many evaluations without a new best (default: 0, no early stopping)')
 parser.add_argument('--batch_size_test', type=int, default=256)
+parser.add_argument('--step_timing', default='off', type=str, choices=['off', 'host', 'sync'],
+                    help='log per-epoch step times: host wall time only, or synced with the device every step')
+parser.add_argument('--profile', default=False, action='store_true',
+                    help='log wall time and FLOPs per model component (patch embeddings, attn, mlp, wavelet '
+                         'adapters, head) at the end of every training epoch')
+parser.add_argument('--profile_trace', default=None, type=str,
+                    help='with --profile, also write a chrome trace of the first epoch to this file')
 parser.add_argument('--epochs', type=int, default=100)
 parser.add_argument('--warmup_epochs', type=int, default=10)
 
@@ -68,16 +111,43 @@ parser.add_argument('--smoothing', type=float, default=0.0, help='Label smoothin
 parser.add_argument('--ema', default=False, action='store_true', help='EMA for model boost (default: False)')
 parser.add_argument('--ema_decay', default=0.9998, type=float, help='EMA decay weights')
 
-parser.add_argument('--amp', action='store_true', default=False,
-                    help='use NVIDIA Apex AMP or Native AMP for mixed precision training')
+parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'],
+                    help='torch.autocast precision on the training device, fp16 with a loss scaler (default: fp32)')
+parser.add_argument('--amp', action='store_true', default=False, help='same as --precision fp16')
 parser.add_argument('--prefetcher', default=False, action='store_true', help='prefetcher signal for data loading')
 parser.add_argument('--num_workers', default=4, type=int)
+parser.add_argument('--device', default=None, type=str, help='device to train on (default: cuda if available, else cpu)')
+parser.add_argument('--dist_backend', default='gloo', type=str,
+                    help='torch.distributed backend when launched with torchrun (--batch_size is per process)')
+parser.add_argument('--channels_last', default=False, action='store_true', help='use channels_last memory layout')
+parser.add_argument('--cache', default=None, type=str, choices=['ram', 'disk'],
+                    help='decode every image once and cache the resized uint8 images in memory or on disk')
+parser.add_argument('--cache_dir', default='cache', type=str, help='directory for --cache disk')
+parser.add_argument('--shard_dir', default=None, type=str,
+                    help='read the splits from shards written by data/pack_vtab.py instead of data_dir')
 parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+parser.add_argument('--sweep', default=None, type=str,
+                    help='YAML list of r/scale/lr/weight_decay/drop_path overrides, trained together on one backbone')
 
 args = parser.parse_args()
 
 if not args.ema:
     args.ema_decay = None
+if args.precision is None:
+    args.precision = 'fp16' if args.amp else 'fp32'
+args.amp = args.precision == 'fp16'
+if args.device is None:
+    args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+args.rank, args.world_size = 0, 1
+if args.distributed:
+    # launched by torchrun, which sets RANK / WORLD_SIZE / LOCAL_RANK and the rendezvous address
+    torch.distributed.init_process_group(backend=args.dist_backend)
+    args.rank, args.world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    if torch.device(args.device).type == 'cuda':
+        args.device = 'cuda:{}'.format(int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(args.device)
+args.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
 # VTAB classes
 if args.dataset == 'cifar_100':
@@ -123,6 +193,9 @@ else:
 
 benchmark = 'VTAB'
 dataset_func = VTAB
+if args.shard_dir:
+    dataset_func = VTABShard
+    args.data_dir = args.shard_dir
 train_transform_type = 'VTAB'
 test_transform_type = 'VTAB'
 train_split = 'train_val'
@@ -132,29 +205,71 @@ args.log_dir = os.path.join('checkpoint', args.model, benchmark, args.dataset,
                             'bs_{}_wd_{}_lr_{}_dp_{}_scale_{}_sed_{}_ema_{}_emadcy_{}_amp_{}_mixup_{}_cutmix_{}_smooth_{}_prefet_{}'
                             .format(args.batch_size, args.weight_decay, args.lr, args.drop_path, args.scale, args.seed, args.ema,
                                     args.ema_decay, args.amp, args.mixup, args.cutmix, args.smoothing, args.prefetcher))
-
-if not os.path.exists(args.log_dir):
-    os.makedirs(args.log_dir)
+if args.img_size != 224:
+    args.log_dir += '_img_{}'.format(args.img_size)
+if args.quantize != 'none':
+    args.log_dir += '_int8_{}'.format(args.quantize)
+if args.precision == 'bf16':
+    args.log_dir += '_bf16'
+if args.sweep:
+    assert args.grad_checkpointing != 'blocks', '--sweep supports --grad_checkpointing attn / mlp only'
+    args.sweep_configs = load_sweep(args.sweep, args)
+    args.log_dir = os.path.join('checkpoint', args.model, benchmark, args.dataset, 'sweep_{}_bs_{}_sed_{}'.format(
+        os.path.splitext(os.path.basename(args.sweep))[0], args.batch_size, args.seed))
+    args.sweep_dirs = [os.path.join(args.log_dir, 'config_{}_r_{r}_scale_{scale}_lr_{lr}_wd_{weight_decay}_dp_{drop_path}'
+                                    .format(k, **config)) for k, config in enumerate(args.sweep_configs)]
+    for sweep_dir in args.sweep_dirs:
+        os.makedirs(sweep_dir, exist_ok=True)
+
+os.makedirs(args.log_dir, exist_ok=True)
 args.log_file = os.path.join(args.log_dir, 'log.txt')
 
 def main():
     write(args, args.log_file)
     random_seed(args.seed)
     if args.model == 'vit_base_patch16_224_in21k':
-        model = create_model(args.model, num_classes=args.num_classes, checkpoint_path=args.load_path,
-                             drop_path_rate=args.drop_path, r=args.r,
-                             scale=args.scale, log_file=args.log_file)
+        model_kwargs = dict(num_classes=args.num_classes, drop_path_rate=args.drop_path, r=args.r,
+                            img_size=args.img_size, attn_backend=args.attn_backend,
+                            weight_cache_dir=args.weight_cache_dir or None, scale=args.scale, log_file=args.log_file)
+        if args.load_path and args.load_path.endswith('.npz') and args.meta_init:
+            model = vision_transformer.create_pretrained(args.model, args.load_path, **model_kwargs)
+        else:
+            model = create_model(args.model, checkpoint_path=args.load_path, **model_kwargs)
     else:
         raise NotImplementedError
+    if args.grad_checkpointing != 'none':
+        model.set_grad_checkpointing(args.grad_checkpointing, every=args.grad_checkpointing_every)
+        write('activation checkpointing: {} (every {})'.format(args.grad_checkpointing, args.grad_checkpointing_every),
+              args.log_file)
+
+    if args.sweep:
+        model = MultiConfigWST(model, args.sweep_configs)
+        write('training {} configurations on one backbone: {}'.format(len(args.sweep_configs), args.sweep_configs),
+              args.log_file)
 
     mark_trainable_parameters(model, model_type=args.model)
-    model.cuda()
+    if args.quantize != 'none':
+        assert args.quantize != 'dynamic' or torch.device(args.device).type == 'cpu', '--quantize dynamic is CPU only'
+        quantize_backbone(model, args.quantize)
+        write('int8 backbone linears: {}'.format(args.quantize), args.log_file)
+    model.to(args.device, memory_format=args.memory_format)
+
+    train_model = model
+    if args.distributed:
+        # DDP only all-reduces the trainable gradients; also skip the initial broadcast of the frozen backbone
+        # and the constant buffers, which every process loaded identically
+        frozen = [n for n, p in model.named_parameters() if not p.requires_grad]
+        DDP._set_params_and_buffers_to_ignore_for_model(model, frozen + [n for n, _ in model.named_buffers()])
+        train_model = DDP(model, device_ids=[args.device] if torch.device(args.device).type == 'cuda' else None,
+                          broadcast_buffers=False)
+        write('distributed training on {} processes ({}), {} trainable tensors all-reduced'.format(
+            args.world_size, args.dist_backend, sum(p.requires_grad for p in model.parameters())), args.log_file)
 
     for n, p in model.named_parameters():
         if p.requires_grad:
             write('requires_grad : {}  with shape {}'.format(n, p.size()), args.log_file)
 
-    best_acc = 0.0
+    best_accs = [0.0] * (len(args.sweep_configs) if args.sweep else 1)
     decay = []
     no_decay = []
     no_decay_name = []
@@ -169,6 +284,8 @@ def main():
             decay.append(param)
 
     params = [{'params': no_decay, 'weight_decay': 0.}, {'params': decay, 'weight_decay': args.weight_decay}]
+    if args.sweep:
+        params = model.param_groups()
     optimizer = optim.AdamW(params, lr=args.lr, weight_decay=0.0)
 
 
@@ -192,11 +309,20 @@ def main():
         model_ema = None
         write('Dont use ema model', args.log_file)
 
-    # create the train and eval datasets
+    # create the train and eval datasets; under torchrun rank 0 goes first, so that it alone writes the shared
+    # on-disk caches and the other ranks load them after the barrier
+    if args.distributed and args.rank != 0:
+        torch.distributed.barrier()
     dataset_train = dataset_func(root=args.data_dir, dataset=args.dataset, split_=train_split,
-                                 transform=create_transform(args.prefetcher, aug_type=train_transform_type))
+                                 transform=create_transform(args.prefetcher, aug_type=train_transform_type,
+                                                            img_size=args.img_size),
+                                 cache=args.cache, cache_dir=args.cache_dir, cache_workers=args.num_workers)
     dataset_eval = dataset_func(root=args.data_dir, dataset=args.dataset, split_=test_split,
-                                transform=create_transform(args.prefetcher, aug_type=test_transform_type))
+                                transform=create_transform(args.prefetcher, aug_type=test_transform_type,
+                                                           img_size=args.img_size),
+                                cache=args.cache, cache_dir=args.cache_dir, cache_workers=args.num_workers)
+    if args.distributed and args.rank == 0:
+        torch.distributed.barrier()
 
 
 
@@ -223,7 +349,10 @@ def main():
         use_prefetcher=args.prefetcher,
         num_workers=args.num_workers,
         collate_fn=collate_fn,
-        log_file=args.log_file
+        log_file=args.log_file,
+        device=args.device,
+        channels_last=args.channels_last,
+        distributed=args.distributed
     )
 
     loader_eval = create_loader(
@@ -233,7 +362,10 @@ def main():
         re_prob=0.,
         use_prefetcher=args.prefetcher,
         num_workers=args.num_workers,
-        log_file=args.log_file
+        log_file=args.log_file,
+        device=args.device,
+        channels_last=args.channels_last,
+        distributed=args.distributed
     )
 
     if mixup_active:
@@ -242,51 +374,146 @@ def main():
     else:
         criterion = nn.CrossEntropyLoss()
         write('Using CrossEntropyLoss', args.log_file)
-
-    loss_scaler = NativeScaler() if args.amp else None
-    autocast = amp_autocast if args.amp else suppress
-
-    if (loss_scaler is not None) and (autocast == amp_autocast):
-        write('Training in AMP', args.log_file)
-    else:
-        write('Training in FP32', args.log_file)
-
-
-
+    if args.sweep:
+        criterion = SweepLoss(criterion)
+
+    # bf16 has the fp32 exponent range, only fp16 needs loss scaling
+    loss_scaler = None
+    autocast = suppress
+    if args.precision != 'fp32':
+        device_type = torch.device(args.device).type
+        autocast = partial(torch.autocast, device_type=device_type,
+                           dtype=torch.bfloat16 if args.precision == 'bf16' else torch.float16)
+    if args.precision == 'fp16':
+        loss_scaler = NativeScaler()
+        if device_type != 'cuda' and hasattr(torch.amp, 'GradScaler'):
+            loss_scaler._scaler = torch.amp.GradScaler(device_type)  # NativeScaler's scaler is CUDA only
+    write('Training in {}'.format(args.precision.upper()), args.log_file)
+
+
+
+    loader_eval_subset = None
+    if 0 < args.eval_subset < len(dataset_eval):
+        # fixed across epochs (and runs with the same seed), so intermediate accuracies are comparable
+        subset = np.random.RandomState(args.seed).choice(len(dataset_eval), args.eval_subset, replace=False)
+        loader_eval_subset = create_loader(
+            torch.utils.data.Subset(dataset_eval, sorted(subset.tolist())),
+            batch_size=args.batch_size_test,
+            is_training=False,
+            re_prob=0.,
+            use_prefetcher=args.prefetcher,
+            num_workers=args.num_workers,
+            log_file=args.log_file,
+            device=args.device,
+            channels_last=args.channels_last,
+            distributed=args.distributed
+        )
+        write('evaluating on {} of {} test images during training'.format(args.eval_subset, len(dataset_eval)),
+              args.log_file)
+
+    run_start = time.time()
+    train_time = eval_time = 0.
+    best_scores, bad_evals = None, 0
+    step_hooks = []
+    if args.profile:
+        step_hooks.append(ModuleProfiler(model, trace_path=args.profile_trace if args.rank == 0 else None))
+    if args.step_timing != 'off':
+        step_hooks.append(StepTimer(args.device, sync=args.step_timing == 'sync'))
     for epoch in range(1, num_epochs + 1):
 
-        train_one_epoch(epoch, model, loader_train,  optimizer, criterion, args,
+        start = time.time()
+        if args.distributed:
+            loader_train.sampler.set_epoch(epoch)
+        train_one_epoch(epoch, train_model, loader_train,  optimizer, criterion, args,
                                         autocast=autocast, model_ema=model_ema, loss_scaler=loss_scaler,
-                                        mixup_fn=mixup_fn)
+                                        mixup_fn=mixup_fn, step_hooks=step_hooks)
 
         lr_scheduler.step(epoch)
-        top1_acc_eval = validate(model, loader_eval, autocast=autocast)
-        if best_acc < top1_acc_eval.avg:
-            best_acc = top1_acc_eval.avg
-            util.save(args.log_dir, model, str='best')
-        if epoch == num_epochs:
-            util.save(args.log_dir, model, str='final')
+        train_time += time.time() - start
+
+        final = epoch == num_epochs
+        if epoch % args.eval_interval and not final:
+            continue
+
+        start = time.time()
+        top1_acc_eval = None
+        if loader_eval_subset is not None and not final:
+            scores = top1_scores(validate(model, loader_eval_subset, autocast=autocast, tag='subset'))
+        else:
+            top1_acc_eval = validate(model, loader_eval, autocast=autocast)
+            scores = top1_scores(top1_acc_eval)
+        improved = best_scores is None or any(s > b for s, b in zip(scores, best_scores))
+        best_scores = scores if best_scores is None else [max(s, b) for s, b in zip(scores, best_scores)]
+        bad_evals = 0 if improved else bad_evals + 1
+        stop = args.patience > 0 and bad_evals >= args.patience
+        if top1_acc_eval is None and (improved or stop):
+            # full test pass only for a new best on the subset, or for the last epoch
+            top1_acc_eval = validate(model, loader_eval, autocast=autocast)
+        if top1_acc_eval is not None:
+            save_checkpoints(model, top1_acc_eval, best_accs, final=final or stop)
+        eval_time += time.time() - start
+
+        if stop:
+            write('early stopping at epoch {}: no improvement in the last {} evaluations'.format(
+                epoch, args.patience), args.log_file)
+            break
 
     if args.ema:
         assert model_ema is not None
-        module_for_validate = model_ema.module
-    else:
-        module_for_validate = model
-
-    top1_acc_eval = validate(module_for_validate, loader_eval, autocast=autocast)
+        start = time.time()
+        top1_acc_eval = validate(model_ema.module, loader_eval, autocast=autocast)
+        eval_time += time.time() - start
+    # without EMA, top1_acc_eval is the full test pass of the last epoch above
+
+    write('wall time: {:.1f}s  train: {:.1f}s  eval: {:.1f}s  epochs: {}'.format(
+        time.time() - run_start, train_time, eval_time, epoch), args.log_file)
+    if args.sweep:
+        for k, top1_m in enumerate(top1_acc_eval):
+            write('config {}: {}   epoch: {}   eval_acc: {:.2f}   best_acc: {:.2f}'.format(
+                k, args.sweep_configs[k], epoch, top1_m.avg, best_accs[k]), log_file=args.log_file)
+        return
     write('epoch: {}   eval_acc: {:.2f}'.format(epoch, top1_acc_eval.avg), log_file=args.log_file)
 
 
+def top1_scores(top1_acc_eval):
+    """ Top-1 accuracies as a list, one per configuration in sweep mode
+    """
+    return [top1_m.avg for top1_m in top1_acc_eval] if args.sweep else [top1_acc_eval.avg]
+
+
+def save_checkpoints(model, top1_acc_eval, best_accs, final):
+    # every process tracks best_accs, only rank 0 writes the (identical) weights
+    save = args.rank == 0
+    if not args.sweep:
+        if best_accs[0] < top1_acc_eval.avg:
+            best_accs[0] = top1_acc_eval.avg
+            if save:
+                util.save(args.log_dir, model, str='best')
+        if final and save:
+            util.save(args.log_dir, model, str='final')
+        return
+    for k, top1_m in enumerate(top1_acc_eval):
+        if best_accs[k] < top1_m.avg:
+            best_accs[k] = top1_m.avg
+            if save:
+                util.save_trainable(args.sweep_dirs[k], model.trainable_state_dict(k), str='best')
+        if final and save:
+            util.save_trainable(args.sweep_dirs[k], model.trainable_state_dict(k), str='final')
+
+
 def train_one_epoch(epoch, model, loader,  optimizer, loss_fn, args, autocast, model_ema=None,
-                    loss_scaler=None, mixup_fn=None):
-    losses_m = AverageMeter()
+                    loss_scaler=None, mixup_fn=None, step_hooks=()):
+    # on-device running loss, the step loop never waits for the device; synced once for the epoch log
+    losses_m = DeviceMeter()
 
     model.train()
+    for step_hook in step_hooks:
+        step_hook.start()
 
     for batch_idx, (input, target) in enumerate(loader):
 
         if not args.prefetcher:
-            input, target = input.cuda(), target.cuda()
+            input, target = input.to(args.device, memory_format=args.memory_format), target.to(args.device)
             if mixup_fn is not None:
                 input, target = mixup_fn(input, target)
 
@@ -294,27 +521,33 @@ def train_one_epoch(epoch, model, loader,  optimizer, loss_fn, args, autocast, m
             output = model(input)
             loss = loss_fn(output, target)
 
-        losses_m.update(loss.item(), input.size(0))
+        losses_m.update(loss, input.size(0))
         optimizer.zero_grad()
 
         if loss_scaler is not None:
-            assert autocast == amp_autocast
+            assert args.precision == 'fp16'
             loss_scaler(loss, optimizer, parameters=model.parameters())
         else:
-            assert autocast == suppress
+            assert args.precision != 'fp16'
             loss.backward()
             optimizer.step()
 
         if model_ema is not None:
             model_ema.update(model)
 
-        lrl = [param_group['lr'] for param_group in optimizer.param_groups]
-        lr = sum(lrl) / len(lrl)
-    write('epoch: {}  '.format(epoch), log_file=args.log_file)
+        for step_hook in step_hooks:
+            step_hook(batch_idx)
+    if args.distributed:
+        losses_m.all_reduce()
+    write('epoch: {}  loss: {:.4f}'.format(epoch, losses_m.avg), log_file=args.log_file)
+    for step_hook in step_hooks:
+        write('epoch: {}  {}'.format(epoch, step_hook.summary()), log_file=args.log_file)
 
 
-def validate(model, loader, autocast):
-    top1_m = AverageMeter()
+def validate(model, loader, autocast, tag=''):
+    if args.sweep:
+        return validate_sweep(model, loader, autocast, tag)
+    top1_m = DeviceMeter()
 
     model.eval()
 
@@ -322,19 +555,48 @@ def validate(model, loader, autocast):
         for batch_idx, (input, target) in enumerate(loader):
 
             if not args.prefetcher:
-                input = input.cuda()
-                target = target.cuda()
+                input = input.to(args.device, memory_format=args.memory_format)
+                target = target.to(args.device)
 
             with autocast():
 
                 output = model(input)
 
-            acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            top1_m.update(acc1.item(), output.size(0))
+            top1_m.update(top1_correct(output, target), output.size(0))
 
-    write('Acc@1: {top1.avg:>7.4f}'.format(top1=top1_m), args.log_file)
+    if args.distributed:
+        top1_m.all_reduce()
+    write('Acc@1{}: {top1.avg:>7.4f}'.format(' ({})'.format(tag) if tag else '', top1=top1_m), args.log_file)
     return top1_m
 
 
+def validate_sweep(model, loader, autocast, tag=''):
+    top1_ms = [DeviceMeter() for _ in args.sweep_configs]
+
+    model.eval()
+
+    with torch.no_grad():
+        for batch_idx, (input, target) in enumerate(loader):
+
+            if not args.prefetcher:
+                input = input.to(args.device, memory_format=args.memory_format)
+                target = target.to(args.device)
+
+            with autocast():
+
+                output = model(input)
+
+            for top1_m, out in zip(top1_ms, output):
+                top1_m.update(top1_correct(out, target), out.size(0))
+
+    if args.distributed:
+        for top1_m in top1_ms:
+            top1_m.all_reduce()
+    write('Acc@1{}: '.format(' ({})'.format(tag) if tag else '') + '  '.join('{:>7.4f}'.format(top1_m.avg) for top1_m in top1_ms), args.log_file)
+    return top1_ms
+
+
 if __name__ == '__main__':
     main()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
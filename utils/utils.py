@@ -9,6 +9,8 @@ import torch.nn as nn
 import torch.nn.init as init
 import logging
 import os
+import queue
+import threading
 from collections import OrderedDict
 import torch.nn.functional as F
 import torch.utils.data
@@ -24,7 +26,7 @@ from timm.data.random_erasing import RandomErasing
 from timm.data.mixup import FastCollateMixup
 from timm.data.transforms_factory import RandomResizedCropAndInterpolation
 from timm.data.auto_augment import rand_augment_transform
-from data.vtab import VTAB
+from data.vtab import VTAB, ContiguousBatch
 # from torch.cuda.amp import autocast as amp_autocast
 
 IMAGENET_INCEPTION_MEAN = (0.5, 0.5, 0.5)
@@ -40,6 +42,11 @@ def expand_to_chs(x, n):
     return x
 
 class PrefetchLoader:
+    """ Moves uint8 batches to device and normalizes them there, one batch ahead of the consumer.
+
+    On CUDA the copy and normalization of batch N+1 run on a side stream, on other devices in a background
+    thread, overlapping with the compute on batch N either way. channels_last=True yields NHWC-strided inputs.
+    """
 
     def __init__(
             self,
@@ -51,38 +58,53 @@ class PrefetchLoader:
             re_prob=0.,
             re_mode='const',
             re_count=1,
-            re_num_splits=0):
+            re_num_splits=0,
+            device=None,
+            channels_last=False):
 
         mean = expand_to_chs(mean, channels)
         std = expand_to_chs(std, channels)
         normalization_shape = (1, channels, 1, 1)
 
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
         self.loader = loader
-        self.mean = torch.tensor([x * 255 for x in mean]).cuda().view(normalization_shape)
-        self.std = torch.tensor([x * 255 for x in std]).cuda().view(normalization_shape)
+        self.mean = torch.tensor([x * 255 for x in mean], device=self.device).view(normalization_shape)
+        self.std = torch.tensor([x * 255 for x in std], device=self.device).view(normalization_shape)
         self.fp16 = fp16
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
         if fp16:
             self.mean = self.mean.half()
             self.std = self.std.half()
         if re_prob > 0.:
-            self.random_erasing = RandomErasing(probability=re_prob, mode=re_mode, max_count=re_count, num_splits=re_num_splits)
+            self.random_erasing = RandomErasing(probability=re_prob, mode=re_mode, max_count=re_count, num_splits=re_num_splits,
+                                                device=self.device)
         else:
             self.random_erasing = None
 
+    def _preprocess(self, input, target):
+        non_blocking = self.device.type == 'cuda'
+        input = input.to(self.device, non_blocking=non_blocking)
+        target = target.to(self.device, non_blocking=non_blocking)
+        input = input.to(dtype=torch.half if self.fp16 else torch.float, memory_format=self.memory_format)
+        input = input.sub_(self.mean).div_(self.std)
+        if self.random_erasing is not None:
+            input = self.random_erasing(input)
+        return input, target
+
     def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def _iter_stream(self):
         stream = torch.cuda.Stream()
         first = True
 
         for next_input, next_target in self.loader:
             with torch.cuda.stream(stream):
-                next_input = next_input.cuda(non_blocking=True)
-                next_target = next_target.cuda(non_blocking=True)
-                if self.fp16:
-                    next_input = next_input.half().sub_(self.mean).div_(self.std)
-                else:
-                    next_input = next_input.float().sub_(self.mean).div_(self.std)
-                if self.random_erasing is not None:
-                    next_input = self.random_erasing(next_input)
+                next_input, next_target = self._preprocess(next_input, next_target)
 
             if not first:
                 yield input, target
@@ -95,6 +117,44 @@ class PrefetchLoader:
 
         yield input, target
 
+    def _iter_thread(self):
+        # torch ops release the GIL, so preprocessing in the thread runs alongside the consumer's compute
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for next_input, next_target in self.loader:
+                    if not put(self._preprocess(next_input, next_target)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
     def __len__(self):
         return len(self.loader)
 
@@ -134,12 +194,105 @@ def _worker_init(worker_id, worker_seeding='all'):
             np.random.seed(worker_info.seed % (2 ** 32 - 1))
 
 
+def is_primary():
+    """ True outside of torch.distributed and on rank 0, the process that logs and saves checkpoints
+    """
+    return not (torch.distributed.is_available() and torch.distributed.is_initialized()) or \
+        torch.distributed.get_rank() == 0
+
+
 def write(print_obj, log_file=None, end='\n'):
+    if not is_primary():
+        return
     print(print_obj, end=end)
     if log_file is not None:
         with open(log_file, 'a') as f:
             print(print_obj, end=end, file=f)
 
+
+class DeviceMeter:
+    """ Running average of tensor values kept on their device, update() never waits for the device.
+    Reading .avg syncs once.
+    """
+    def __init__(self):
+        self.sum = None
+        self.count = 0
+        self._avg = None
+
+    def update(self, val, n=1):
+        val = val.detach().float() * n
+        self.sum = val if self.sum is None else self.sum.add_(val)
+        self.count += n
+        self._avg = None
+
+    def all_reduce(self):
+        """ Sum and count over the processes of the default torch.distributed group (one sync), on the meter's
+        device (nccl only reduces cuda tensors)
+        """
+        if self.sum is not None:
+            device = self.sum.device
+        elif torch.distributed.get_backend() == 'nccl':
+            device = torch.device('cuda', torch.cuda.current_device())  # nothing seen on this rank
+        else:
+            device = torch.device('cpu')
+        stats = torch.zeros(2, dtype=torch.float64, device=device)
+        if self.sum is not None:
+            stats[0] = self.sum
+        stats[1] = self.count
+        torch.distributed.all_reduce(stats)
+        self.sum, self.count, self._avg = stats[0], int(stats[1].item()), None
+
+    @property
+    def avg(self):
+        if self._avg is None:
+            self._avg = self.sum.item() / self.count if self.count else 0.
+        return self._avg
+
+
+def top1_correct(output, target):
+    """ Top-1 accuracy (%) of a batch as a 0-dim tensor on the output's device
+    """
+    return (output.argmax(-1) == target).float().mean() * 100.
+
+
+class StepTimer:
+    """ Step-time hook for train_one_epoch: host wall time between calls, summarized per epoch.
+
+    Without sync the host only waits for the device where the loop itself syncs, so the step times show how
+    far it can run ahead; sync=True waits for the device every step (device step times, at the cost of the
+    syncs the loop avoids).
+    """
+    def __init__(self, device='cpu', sync=False):
+        self.device = torch.device(device)
+        self.sync = sync
+        self.start()
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start(self):
+        self.times = []
+        self.epoch_start = self.last = time.perf_counter()
+
+    def __call__(self, step):
+        if self.sync:
+            self._synchronize()
+        now = time.perf_counter()
+        self.times.append(now - self.last)
+        self.last = now
+
+    def summary(self):
+        self._synchronize()
+        total = time.perf_counter() - self.epoch_start
+        if not self.times:
+            return 'no steps'
+        times = np.array(self.times[1:] or self.times) * 1e3  # the first step includes loader start-up
+        return 'steps: {}  step {:.1f} ms (p50 {:.1f}, p90 {:.1f}, {})  epoch {:.1f}s'.format(
+            len(self.times), times.mean(), np.percentile(times, 50), np.percentile(times, 90),
+            'synced' if self.sync else 'host', total)
+
+
 class ToNumpy:
 
     def __call__(self, pil_img):
@@ -149,19 +302,22 @@ class ToNumpy:
         np_img = np.rollaxis(np_img, 2)  # HWC to CHW
         return np_img
 
-def create_transform(use_prefetcher=False, aug_type=False, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
+def create_transform(use_prefetcher=False, aug_type=False, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5), img_size=224):
+
+    # resize sizes below were tuned at 224 and scale with the input resolution
+    resize_size = int(img_size * 256 / 224)
 
     if aug_type == 'VTAB':
 
         tfl = [
-            transforms.Resize(size=(224, 224), interpolation=InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
+            transforms.Resize(size=(img_size, img_size), interpolation=InterpolationMode.BICUBIC),
+            transforms.CenterCrop(img_size),
         ]
 
     elif aug_type == 'FGVC_train':
 
         tfl = [
-            RandomResizedCropAndInterpolation(224, interpolation='bicubic'),
+            RandomResizedCropAndInterpolation(img_size, interpolation='bicubic'),
             transforms.RandomHorizontalFlip(),
         ]
 
@@ -169,31 +325,31 @@ def create_transform(use_prefetcher=False, aug_type=False, mean=(0.5, 0.5, 0.5),
     elif aug_type =='FGVC_test':
 
         tfl = [
-            transforms.Resize(248, interpolation=InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
+            transforms.Resize(int(img_size / 0.9), interpolation=InterpolationMode.BICUBIC),
+            transforms.CenterCrop(img_size),
         ]
 
     elif aug_type == 'FGFS_train':
 
         tfl = [
-            RandomResizedCropAndInterpolation(224, interpolation='bicubic'),
+            RandomResizedCropAndInterpolation(img_size, interpolation='bicubic'),
             transforms.RandomHorizontalFlip(),
         ]
 
-        img_size_min = 224
+        img_size_min = img_size
         aa_params = dict(translate_const=int(img_size_min * 0.45), img_mean=tuple([min(255, round(255 * x)) for x in mean]), interpolation=3)
         tfl += [rand_augment_transform('rand-m9-mstd0.5-inc1', aa_params)]
 
     elif aug_type == 'FGFS_test':
 
         tfl = [
-            transforms.Resize((256,256), interpolation=InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
+            transforms.Resize((resize_size, resize_size), interpolation=InterpolationMode.BICUBIC),
+            transforms.CenterCrop(img_size),
         ]
     elif aug_type == 'efficientnet_test':
         tfl = [
-            transforms.Resize(256, interpolation=InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
+            transforms.Resize(resize_size, interpolation=InterpolationMode.BICUBIC),
+            transforms.CenterCrop(img_size),
         ]
     else:
         raise NotImplementedError
@@ -210,39 +366,89 @@ def create_transform(use_prefetcher=False, aug_type=False, mean=(0.5, 0.5, 0.5),
 
     return transform
 
-def fast_collate(batch):
-    """ A fast collation function optimized for uint8 images (np array or torch) and int64 targets (labels)"""
-    assert isinstance(batch[0], tuple)
-    batch_size = len(batch)
-    if isinstance(batch[0][0], tuple):
-        # This branch 'deinterleaves' and flattens tuples of input tensors into one tensor ordered by position
-        # such that all tuple of position n will end up in a torch.split(tensor, batch_size) in nth position
-        inner_tuple_size = len(batch[0][0])
-        flattened_batch_size = batch_size * inner_tuple_size
-        targets = torch.zeros(flattened_batch_size, dtype=torch.int64)
-        tensor = torch.zeros((flattened_batch_size, *batch[0][0][0].shape), dtype=torch.uint8)
-        for i in range(batch_size):
-            assert len(batch[i][0]) == inner_tuple_size  # all input tensor tuples must be same length
+class FastCollate:
+    """ A fast collation function optimized for uint8 images (np array or torch) and int64 targets (labels)
+
+    Samples are copied once, straight into the (preallocated) batch tensor. Batches that a memmap backed
+    dataset hands over as one ContiguousBatch are used as they are.
+
+    num_buffers > 0 keeps a ring of reusable, optionally pinned, output buffers instead of allocating one per
+    batch. Only use it when collation runs in the main process (num_workers=0): worker outputs are shared with
+    the main process, not copied, so a reused buffer would be overwritten while still in use. The ring must be
+    deeper than the number of batches alive at once (PrefetchLoader holds two).
+    """
+
+    def __init__(self, num_buffers=0, pin_memory=False):
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = []
+        self._next = 0
+
+    def _empty(self, shape):
+        if not self.num_buffers:
+            return torch.empty(shape, dtype=torch.uint8)
+        if len(self._buffers) < self.num_buffers:
+            self._buffers.append(torch.empty(shape, dtype=torch.uint8, pin_memory=self.pin_memory))
+        buf = self._buffers[self._next % len(self._buffers)]
+        self._next += 1
+        if buf.shape != shape:
+            # last (smaller) batch of an epoch or a new shape
+            buf = torch.empty(shape, dtype=torch.uint8, pin_memory=self.pin_memory)
+        return buf
+
+    @staticmethod
+    def _stack(samples, out):
+        if isinstance(samples[0], np.ndarray):
+            np.stack(samples, out=out.numpy())
+        else:
+            torch.stack(samples, out=out)
+
+    def __call__(self, batch):
+        if isinstance(batch, ContiguousBatch):
+            targets = torch.from_numpy(np.asarray(batch.targets, dtype=np.int64))
+            images = torch.from_numpy(batch.images)
+            if self.num_buffers:
+                images = self._empty(images.shape).copy_(images)
+            return images, targets
+        assert isinstance(batch[0], tuple)
+        batch_size = len(batch)
+        labels = torch.tensor([b[1] for b in batch], dtype=torch.int64)
+        if isinstance(batch[0][0], tuple):
+            # This branch 'deinterleaves' and flattens tuples of input tensors into one tensor ordered by position
+            # such that all tuple of position n will end up in a torch.split(tensor, batch_size) in nth position
+            inner_tuple_size = len(batch[0][0])
+            assert all(len(b[0]) == inner_tuple_size for b in batch)  # all input tensor tuples must be same length
+            tensor = self._empty((batch_size * inner_tuple_size, *batch[0][0][0].shape))
             for j in range(inner_tuple_size):
-                targets[i + j * batch_size] = batch[i][1]
-                tensor[i + j * batch_size] += torch.from_numpy(batch[i][0][j])
-        return tensor, targets
-    elif isinstance(batch[0][0], np.ndarray):
-        targets = torch.tensor([b[1] for b in batch], dtype=torch.int64)
-        assert len(targets) == batch_size
-        tensor = torch.zeros((batch_size, *batch[0][0].shape), dtype=torch.uint8)
-        for i in range(batch_size):
-            tensor[i] += torch.from_numpy(batch[i][0])
-        return tensor, targets
-    elif isinstance(batch[0][0], torch.Tensor):
-        targets = torch.tensor([b[1] for b in batch], dtype=torch.int64)
-        assert len(targets) == batch_size
-        tensor = torch.zeros((batch_size, *batch[0][0].shape), dtype=torch.uint8)
-        for i in range(batch_size):
-            tensor[i].copy_(batch[i][0])
-        return tensor, targets
-    else:
-        assert False
+                self._stack([b[0][j] for b in batch], tensor[j * batch_size:(j + 1) * batch_size])
+            return tensor, labels.repeat(inner_tuple_size)
+        elif isinstance(batch[0][0], (np.ndarray, torch.Tensor)):
+            tensor = self._empty((batch_size, *batch[0][0].shape))
+            self._stack([b[0] for b in batch], tensor)
+            return tensor, labels
+        else:
+            assert False
+
+
+fast_collate = FastCollate()
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """ Every num_replicas-th sample in order, starting at rank. Unlike DistributedSampler the shards are not
+    padded to the same length, so a distributed evaluation sees every sample exactly once.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = torch.distributed.get_world_size() if num_replicas is None else num_replicas
+        self.rank = torch.distributed.get_rank() if rank is None else rank
+        self.indices = range(self.rank, len(dataset), self.num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
 
 def create_loader(
         dataset,
@@ -254,23 +460,43 @@ def create_loader(
         collate_fn=None,
         fp16=False,
         persistent_workers=True,
-        log_file=None
+        log_file=None,
+        device=None,
+        channels_last=False,
+        distributed=False
 ):
+    """
+    distributed: shard the dataset over the processes of the default torch.distributed group, shuffled by a
+        DistributedSampler for training (call loader.sampler.set_epoch every epoch), in order and without
+        padding for evaluation.
+    """
 
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    pin_memory = torch.device(device).type == 'cuda'
 
     if collate_fn is None:
-        collate_fn = fast_collate if use_prefetcher else torch.utils.data.dataloader.default_collate
+        if use_prefetcher and num_workers == 0:
+            # batches are collated in this process, so output buffers can be reused across batches
+            collate_fn = FastCollate(num_buffers=4, pin_memory=pin_memory)
+        else:
+            collate_fn = fast_collate if use_prefetcher else torch.utils.data.dataloader.default_collate
+
+    sampler = None
+    if distributed:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset) if is_training else ShardSampler(dataset)
 
     loader_class = torch.utils.data.DataLoader
 
     loader_args = dict(
         batch_size=batch_size,
-        shuffle=is_training,
+        shuffle=is_training and sampler is None,
+        sampler=sampler,
         num_workers=num_workers,
         collate_fn=collate_fn,
-        pin_memory=True,
+        pin_memory=pin_memory,
         drop_last=is_training,
-        persistent_workers=persistent_workers
+        persistent_workers=persistent_workers and num_workers > 0
     )
     try:
         loader = loader_class(dataset, **loader_args)
@@ -287,7 +513,9 @@ def create_loader(
             re_prob=prefetch_re_prob,
             re_mode='pixel',
             re_count=1,
-            re_num_splits=0
+            re_num_splits=0,
+            device=device,
+            channels_last=channels_last
         )
 
     return loader
@@ -299,6 +527,10 @@ def save(log_dir, model, str):
     for n, p in model.named_parameters():
         if 'small_' in n or 'adapter' in n or 'head' in n:
             trainable[n] = p.data
+    save_trainable(log_dir, trainable, str)
+
+
+def save_trainable(log_dir, trainable, str):
     torch.save(trainable, './%s/%s_save_model.pt' % ( log_dir,str))
 
 
@@ -8,6 +8,20 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.autograd import Variable, gradcheck
 
+# wavelets that get the closed-form (slicing + add/sub) path instead of grouped convolutions
+HAAR_WAVES = ('haar', 'db1')
+
+
+def use_fast(wave, fast=None):
+    """ Whether the closed-form Haar path applies: by default for HAAR_WAVES, and fast=True only for those
+    """
+    if fast is None:
+        return wave in HAAR_WAVES
+    if fast and wave not in HAAR_WAVES:
+        raise ValueError('the fast path only computes the Haar transform, not {!r} (one of {})'.format(
+            wave, HAAR_WAVES))
+    return fast
+
 
 class DWT_Function(Function):
     @staticmethod
@@ -15,15 +29,7 @@ class DWT_Function(Function):
         x = x.contiguous()
         ctx.save_for_backward(w_ll, w_lh, w_hl, w_hh)
         ctx.shape = x.shape
-
-        dim = x.shape[1]
-
-        x_ll = torch.nn.functional.conv2d(x, w_ll.expand(dim, -1, -1, -1), stride=2, groups=dim)
-        x_lh = torch.nn.functional.conv2d(x, w_lh.expand(dim, -1, -1, -1), stride=2, groups=dim)
-        x_hl = torch.nn.functional.conv2d(x, w_hl.expand(dim, -1, -1, -1), stride=2, groups=dim)
-        x_hh = torch.nn.functional.conv2d(x, w_hh.expand(dim, -1, -1, -1), stride=2, groups=dim)
-        x = torch.cat([x_ll, x_lh, x_hl, x_hh], dim=1)
-        return x
+        return dwt_conv(x, w_ll, w_lh, w_hl, w_hh)
 
     @staticmethod
     def backward(ctx, dx):
@@ -44,14 +50,7 @@ class IDWT_Function(Function):
     def forward(ctx, x, filters):
         ctx.save_for_backward(filters)
         ctx.shape = x.shape
-
-        B, _, H, W = x.shape
-        x = x.view(B, 4, -1, H, W).transpose(1, 2)
-        C = x.shape[1]
-        x = x.reshape(B, -1, H, W)
-        filters = filters.repeat(C, 1, 1, 1)
-        x = torch.nn.functional.conv_transpose2d(x, filters, stride=2, groups=C)
-        return x
+        return idwt_conv(x, filters)
 
     @staticmethod
     def backward(ctx, dx):
@@ -71,9 +70,113 @@ class IDWT_Function(Function):
         return dx, None
 
 
-class IDWT_2D(nn.Module):
-    def __init__(self, wave):
+def _check_even(x):
+    # the stride-2 transform would drop the last row / column of odd sizes, and the IDWT could not invert it
+    if torch.jit.is_tracing():
+        return  # sizes are traced as tensors, the eager model was checked
+    H, W = x.shape[-2:]
+    assert H % 2 == 0 and W % 2 == 0, 'the DWT needs even height and width, got {}x{}'.format(H, W)
+
+
+def dwt_conv(x, w_ll, w_lh, w_hl, w_hh):
+    """ DWT from grouped strided convs only: differentiable by autograd and capturable by torch.compile,
+    torch.jit.trace and ONNX export. Same output as DWT_Function.
+    """
+    _check_even(x)
+    dim = x.shape[1]
+    return torch.cat([F.conv2d(x, w.expand(dim, -1, -1, -1), stride=2, groups=dim)
+                      for w in (w_ll, w_lh, w_hl, w_hh)], dim=1)
+
+
+def idwt_conv(x, filters):
+    """ IDWT from a grouped transposed conv only, same output as IDWT_Function
+    """
+    B, _, H, W = x.shape
+    x = x.reshape(B, 4, -1, H, W).transpose(1, 2)
+    C = x.shape[1]
+    x = x.reshape(B, -1, H, W)
+    return F.conv_transpose2d(x, filters.repeat(C, 1, 1, 1), stride=2, groups=C)
+
+
+def dwt_haar(x):
+    """ Closed-form Haar DWT, same output layout as DWT_Function: cat([ll, lh, hl, hh], dim=1)
+    """
+    _check_even(x)
+    top, bottom = x[:, :, 0::2], x[:, :, 1::2]
+    row_sum, row_diff = top + bottom, top - bottom
+    s0, s1 = row_sum[..., 0::2], row_sum[..., 1::2]
+    d0, d1 = row_diff[..., 0::2], row_diff[..., 1::2]
+    return torch.cat([s0 + s1, d0 + d1, s0 - s1, d0 - d1], dim=1).mul_(0.5)
+
+
+def idwt_haar(x):
+    """ Closed-form Haar IDWT, inverse of dwt_haar
+    """
+    B, _, H, W = x.shape
+    x_ll, x_lh, x_hl, x_hh = x.reshape(B, 4, -1, H, W).unbind(1)
+    p, m = x_ll + x_lh, x_ll - x_lh
+    q, r = x_hl + x_hh, x_hl - x_hh
+    # interleave the 2x2 sub-pixels: (B, C, H, 2, W, 2) -> (B, C, 2H, 2W)
+    top = torch.stack([p + q, p - q], dim=-1)
+    bottom = torch.stack([m + r, m - r], dim=-1)
+    return torch.stack([top, bottom], dim=3).mul_(0.5).reshape(B, -1, 2 * H, 2 * W)
+
+
+def compute_dtype(x):
+    """ dtype the wavelet ops should run in: the autocast dtype when autocast is on for x's device, else x.dtype
+    """
+    device_type = x.device.type
+    if hasattr(torch, 'get_autocast_dtype'):
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+    elif device_type == 'cuda' and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    elif device_type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return x.dtype
+
+
+def _capturing():
+    """ True while torch.jit.trace / torch.compile / torch.export (or ONNX export, which traces) records a graph
+    """
+    if torch.jit.is_tracing():
+        return True
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+
+class _WaveletFilters(nn.Module):
+    """ Keeps the filter bank as fp32 buffers (so they follow model.to()) and hands out copies
+    cast to the activation dtype, cached per (dtype, device).
+    """
+    filter_names = ()
+
+    def __init__(self):
+        super(_WaveletFilters, self).__init__()
+        self._filter_cache = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        self._filter_cache = {}
+        return super(_WaveletFilters, self)._apply(fn, *args, **kwargs)
+
+    def cast_filters(self, dtype, device):
+        if _capturing():
+            # a cached copy would be baked into (or leak out of) the captured graph, cast the buffers in the graph
+            return tuple(getattr(self, n).to(device=device, dtype=dtype) for n in self.filter_names)
+        key = (dtype, device)
+        filters = self._filter_cache.get(key)
+        if filters is None:
+            filters = tuple(getattr(self, n).to(device=device, dtype=dtype) for n in self.filter_names)
+            self._filter_cache[key] = filters
+        return filters
+
+
+class IDWT_2D(_WaveletFilters):
+    filter_names = ('filters',)
+
+    def __init__(self, wave, fast=None):
         super(IDWT_2D, self).__init__()
+        self.fast = use_fast(wave, fast)
         w = pywt.Wavelet(wave)
         rec_hi = torch.Tensor(w.rec_hi)
         rec_lo = torch.Tensor(w.rec_lo)
@@ -89,15 +192,21 @@ class IDWT_2D(nn.Module):
         w_hh = w_hh.unsqueeze(0).unsqueeze(1)
         filters = torch.cat([w_ll, w_lh, w_hl, w_hh], dim=0)
         self.register_buffer('filters', filters)
-        self.filters = self.filters.to(dtype=torch.float16)
 
     def forward(self, x):
-        return IDWT_Function.apply(x, self.filters)
+        x = x.to(compute_dtype(x))
+        if self.fast:
+            return idwt_haar(x)
+        filters, = self.cast_filters(x.dtype, x.device)
+        return idwt_conv(x, filters)
 
 
-class DWT_2D(nn.Module):
-    def __init__(self, wave):
+class DWT_2D(_WaveletFilters):
+    filter_names = ('w_ll', 'w_lh', 'w_hl', 'w_hh')
+
+    def __init__(self, wave, fast=None):
         super(DWT_2D, self).__init__()
+        self.fast = use_fast(wave, fast)
         w = pywt.Wavelet(wave)
         dec_hi = torch.Tensor(w.dec_hi[::-1])
         dec_lo = torch.Tensor(w.dec_lo[::-1])
@@ -112,11 +221,9 @@ class DWT_2D(nn.Module):
         self.register_buffer('w_hl', w_hl.unsqueeze(0).unsqueeze(0))
         self.register_buffer('w_hh', w_hh.unsqueeze(0).unsqueeze(0))
 
-        self.w_ll = self.w_ll.to(dtype=torch.float16)
-        self.w_lh = self.w_lh.to(dtype=torch.float16)
-        self.w_hl = self.w_hl.to(dtype=torch.float16)
-        self.w_hh = self.w_hh.to(dtype=torch.float16)
-
     def forward(self, x):
-        return DWT_Function.apply(x, self.w_ll, self.w_lh, self.w_hl, self.w_hh)
+        x = x.to(compute_dtype(x))
+        if self.fast:
+            return dwt_haar(x)
+        return dwt_conv(x, *self.cast_filters(x.dtype, x.device))
 